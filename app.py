@@ -1,59 +1,2554 @@
 import os
+import re
 import uuid
 import json
 import base64
+import bisect
+import glob
+import collections
+import fcntl
+import hashlib
+import html
+import http.client
 import io
-from datetime import datetime, timedelta
-from urllib.parse import urlencode
-from urllib.request import urlopen, Request
-from flask import Flask, request, jsonify, send_file
+import itertools
+import queue
+import shutil
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime
+from urllib.parse import urlsplit
+from flask import Flask, Response, g, request, jsonify, send_file
 from flask_cors import CORS
+from flask_sock import Sock, ConnectionClosed
+from werkzeug.exceptions import RequestEntityTooLarge
 import logging
 
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
 # Logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 CORS(app)
+app.config['SOCK_SERVER_OPTIONS'] = {'ping_interval': 25}
+sock = Sock(app)
 
 # Config
 BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', '8295821417:AAEZytkScbqqajoK4kw2UyFHt96bKXYOa-A')
 ADMIN_ID = os.environ.get('ADMIN_CHAT_ID', '2098068100')
-TELEGRAM_API = f'https://api.telegram.org/bot{BOT_TOKEN}'
+# Point at a local stand-in (benchmarks/load_test.py) to test without Telegram
+TELEGRAM_API_BASE = os.environ.get('TELEGRAM_API_BASE', 'https://api.telegram.org').rstrip('/')
+TELEGRAM_API = f'{TELEGRAM_API_BASE}/bot{BOT_TOKEN}'
+TELEGRAM_FILE_API = f'{TELEGRAM_API_BASE}/file/bot{BOT_TOKEN}'
+TELEGRAM_TIMEOUT = float(os.environ.get('TELEGRAM_TIMEOUT', 30))
+TELEGRAM_WORKERS = int(os.environ.get('TELEGRAM_WORKERS', 4))
+TELEGRAM_QUEUE_SIZE = int(os.environ.get('TELEGRAM_QUEUE_SIZE', 1000))
+# Bot API limits: ~1 message/sec per chat, ~30/sec overall
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', 1))
+TELEGRAM_CHAT_BURST = float(os.environ.get('TELEGRAM_CHAT_BURST', 3))
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', 30))
+TELEGRAM_MAX_RETRIES = int(os.environ.get('TELEGRAM_MAX_RETRIES', 3))
+SESSION_TTL = float(os.environ.get('SESSION_TTL_HOURS', 24)) * 3600
+SESSION_IDLE_TTL = float(os.environ.get('SESSION_IDLE_HOURS', 0)) * 3600
+CLOSED_SESSION_GRACE = float(os.environ.get('CLOSED_SESSION_GRACE', 300))
+SWEEP_INTERVAL = float(os.environ.get('SWEEP_INTERVAL', 60))
+COALESCE_WINDOW = float(os.environ.get('COALESCE_WINDOW', 10))
+SESSIONS_PAGE_SIZE = int(os.environ.get('SESSIONS_PAGE_SIZE', 10))
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 4))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 1000))
+WEBHOOK_DEDUP_WINDOW = int(os.environ.get('WEBHOOK_DEDUP_WINDOW', 10000))
+LONG_POLL_MAX = float(os.environ.get('LONG_POLL_MAX', 25))
+HISTORY_PAGE_SIZE = int(os.environ.get('HISTORY_PAGE_SIZE', 30))
+HISTORY_PAGE_MAX = int(os.environ.get('HISTORY_PAGE_MAX', 100))
+SSE_HEARTBEAT = float(os.environ.get('SSE_HEARTBEAT', 15))
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'memory')
+NODE_ID = os.environ.get('NODE_ID') or f'{socket.gethostname()}-{os.getpid()}'
+NODE_NUMBER = int(os.environ.get('NODE_NUMBER') or zlib.crc32(NODE_ID.encode()) & 0x3FF)
+BUS_URL = os.environ.get('BUS_URL', '')
+BUS_PEERS = [peer.strip() for peer in os.environ.get('BUS_PEERS', '').split(',') if peer.strip()]
+BUS_HEARTBEAT = float(os.environ.get('BUS_HEARTBEAT', 5))
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'chat.db')
+BLOB_DIR = os.environ.get('BLOB_DIR', 'blobs')
+UPLOAD_DIR = os.environ.get('UPLOAD_DIR', os.path.join(BLOB_DIR, 'uploads'))
+UPLOAD_MAX_BYTES = int(os.environ.get('UPLOAD_MAX_BYTES', 50 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 1024 * 1024))
+IMAGE_DISPLAY_MAX = int(os.environ.get('IMAGE_DISPLAY_MAX', 1600))
+IMAGE_THUMB_MAX = int(os.environ.get('IMAGE_THUMB_MAX', 320))
+IMAGE_QUALITY = int(os.environ.get('IMAGE_QUALITY', 82))
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+IMAGE_QUEUE_SIZE = int(os.environ.get('IMAGE_QUEUE_SIZE', 100))
+# Bot API upload limits for sendPhoto / sendDocument
+TELEGRAM_PHOTO_LIMIT = int(os.environ.get('TELEGRAM_PHOTO_LIMIT', 10 * 1024 * 1024))
+TELEGRAM_DOCUMENT_LIMIT = int(os.environ.get('TELEGRAM_DOCUMENT_LIMIT', 50 * 1024 * 1024))
+HISTORY_DIR = os.environ.get('HISTORY_DIR', os.path.join(BLOB_DIR, 'history'))
+MESSAGE_RETAIN = int(os.environ.get('MESSAGE_RETAIN', 50))
+MESSAGE_HOT_MAX = int(os.environ.get('MESSAGE_HOT_MAX', 500))
+FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE', 5000))
+JOURNAL_DIR = os.environ.get('JOURNAL_DIR', os.path.join(BLOB_DIR, 'journal'))
+JOURNAL_FSYNC = os.environ.get('JOURNAL_FSYNC', 'interval')
+JOURNAL_FSYNC_INTERVAL = float(os.environ.get('JOURNAL_FSYNC_INTERVAL', 1))
+SNAPSHOT_INTERVAL = float(os.environ.get('SNAPSHOT_INTERVAL', 300))
+SNAPSHOT_JOURNAL_BYTES = int(os.environ.get('SNAPSHOT_JOURNAL_BYTES', 16 * 1024 * 1024))
+# Multipart framing and form fields ride on top of the file itself
+app.config['MAX_CONTENT_LENGTH'] = UPLOAD_MAX_BYTES + 64 * 1024
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '') == '1'
+
+# Metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Metrics:
+    """Counters and latency histograms updated in O(1) as events happen,
+    rendered in the Prometheus text format by /metrics.
+    
+    Series are keyed by (name, labels). Labels are route templates, Bot API
+    methods and status codes, never raw paths or IDs, so the set stays small.
+    """
+    
+    HELP = {
+        'livechat_http_requests_total': 'HTTP requests by route, method and status',
+        'livechat_http_request_duration_seconds': 'HTTP request latency by route',
+        'livechat_telegram_requests_total': 'Bot API calls by method and HTTP status',
+        'livechat_telegram_request_duration_seconds': 'Bot API call latency by method, including throttling and retries',
+    }
+    
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+    
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def observe(self, name, labels, seconds):
+        key = (name, labels)
+        with self.lock:
+            series = self.histograms.get(key)
+            if series is None:
+                # Per-bucket counts (the last one is +Inf), then the sum
+                series = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bisect.bisect_left(self.buckets, seconds)] += 1
+            series[-1] += seconds
+    
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ''
+        escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels) + '}'
+    
+    def render(self, gauges):
+        """Text exposition of every series, plus gauges sampled by the
+        caller as (name, help, value) triples"""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(series)) for key, series in self.histograms.items())
+        
+        lines = []
+        described = set()
+        
+        def describe(name, kind, text):
+            if name not in described:
+                described.add(name)
+                lines.append(f'# HELP {name} {text}')
+                lines.append(f'# TYPE {name} {kind}')
+        
+        for (name, labels), value in counters:
+            describe(name, 'counter', self.HELP.get(name, name))
+            lines.append(f'{name}{self.format_labels(labels)} {value}')
+        for (name, labels), series in histograms:
+            describe(name, 'histogram', self.HELP.get(name, name))
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                total += count
+                lines.append(f'{name}_bucket{self.format_labels(labels + (("le", bound),))} {total}')
+            lines.append(f'{name}_sum{self.format_labels(labels)} {round(series[-1], 6)}')
+            lines.append(f'{name}_count{self.format_labels(labels)} {total}')
+        for name, text, value in gauges:
+            describe(name, 'gauge', text)
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+# Session IDs
+class SessionIdGenerator:
+    """Time-sortable session IDs: 41 bits of milliseconds since EPOCH, a
+    10-bit node number and a 12-bit sequence, written as 13 Crockford base32
+    characters after the prefix (SES_0KJ7ZQ4M1B2C5).
+    
+    The sequence is an itertools.count, so threads never contend on a lock;
+    IDs stay unique as long as a node issues fewer than 4096 per millisecond.
+    It starts at a random offset, re-drawn in forked workers, so instances
+    sharing a node number (the default is a hash, or a --preload parent's)
+    are unlikely to issue the same ID in the same millisecond.
+    """
+    
+    ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+    EPOCH = 1704067200000  # 2024-01-01T00:00:00Z in ms
+    
+    def __init__(self, node, prefix='SES_'):
+        self.node = node & 0x3FF
+        self.prefix = prefix
+        self.reseed()
+        os.register_at_fork(after_in_child=self.reseed)
+        # Wall clock read once; the monotonic clock keeps IDs ordered if it is stepped back
+        self.base = time.time_ns() // 1000000 - self.EPOCH
+        self.started = time.monotonic_ns()
+    
+    def reseed(self):
+        self.sequence = itertools.count(int.from_bytes(os.urandom(2), 'big') & 0xFFF)
+    
+    def next(self):
+        ms = self.base + (time.monotonic_ns() - self.started) // 1000000
+        value = ms << 22 | self.node << 12 | next(self.sequence) & 0xFFF
+        chars = []
+        for _ in range(13):
+            value, digit = divmod(value, 32)
+            chars.append(self.ALPHABET[digit])
+        return self.prefix + ''.join(reversed(chars))
+    
+    def timestamp(self, sid):
+        """Creation time (epoch seconds) of an ID from this scheme, else None"""
+        code = sid[len(self.prefix):]
+        if not sid.startswith(self.prefix) or len(code) != 13:
+            return None
+        value = 0
+        for char in code:
+            digit = self.ALPHABET.find(char)
+            if digit < 0:
+                return None
+            value = value * 32 + digit
+        return ((value >> 22) + self.EPOCH) / 1000
+
+if BUS_URL and not os.environ.get('NODE_NUMBER'):
+    logger.warning(f"NODE_NUMBER not set; using {NODE_NUMBER} from a hash of {NODE_ID}. "
+                   f"Give each node a distinct NODE_NUMBER (0-1023) to keep session IDs collision-free")
+sid_generator = SessionIdGenerator(NODE_NUMBER)
 
 # Storage
-sessions = {}
-messages = {}
-files = {}
+def encode_json(value):
+    """Compact JSON text, as cached by MemoryStore and spliced into responses"""
+    return json.dumps(value, separators=(',', ':'))
+
+def iso_time(ts):
+    """ISO-8601 (local time) for an epoch timestamp; strings pass through"""
+    return ts if isinstance(ts, str) else datetime.fromtimestamp(ts).isoformat()
+
+def epoch_time(value):
+    """Epoch seconds for an ISO-8601 string or a number"""
+    return datetime.fromisoformat(value).timestamp() if isinstance(value, str) else float(value)
+
+def file_blobs(record):
+    """Every blob digest a file record references: the original, then its image variants"""
+    digests = [record['blob']] if record.get('blob') else []
+    digests.extend(variant['blob'] for variant in record.get('variants', {}).values())
+    return digests
+
+class PageTable:
+    """A session's distinct (page_url, page_title) pairs; records keep an index.
+    
+    A visitor browses a handful of pages, so a list scanned from the most
+    recent entry is both smaller and about as fast as a dict.
+    """
+    
+    __slots__ = ('pages',)
+    
+    def __init__(self):
+        self.pages = []
+    
+    def intern(self, url, title):
+        key = (url, title)
+        for i in range(len(self.pages) - 1, -1, -1):
+            if self.pages[i] == key:
+                return i
+        self.pages.append(key)
+        return len(self.pages) - 1
+    
+    def __getitem__(self, i):
+        return self.pages[i]
+
+class MessageRecord:
+    """Compact in-memory message: slots instead of a dict, epoch timestamp,
+    interned sender/type and a page table index instead of URL/title strings.
+    
+    pack()/unpack() convert from/to the message dicts the rest of the app
+    (and the API) uses; unknown keys ride along in extra. The JSON encoding
+    is not kept here: MemoryStore caches a bounded number of fragments.
+    """
+    
+    __slots__ = ('seq', 'sender', 'kind', 'text', 'ts', 'page', 'file_id', 'filename', 'extra')
+    FIELDS = frozenset(('seq', 'from', 'type', 'message', 'timestamp', 'page_url', 'page_title', 'file_id', 'filename'))
+    
+    @classmethod
+    def pack(cls, msg, seq, pages):
+        record = cls()
+        record.seq = seq
+        record.sender = sys.intern(msg['from'])
+        record.kind = sys.intern(msg.get('type', 'text'))
+        record.text = msg.get('message', '')
+        record.ts = epoch_time(msg['timestamp']) if 'timestamp' in msg else time.time()
+        if 'page_url' in msg or 'page_title' in msg:
+            record.page = pages.intern(msg.get('page_url'), msg.get('page_title'))
+        else:
+            record.page = -1
+        record.file_id = msg.get('file_id')
+        record.filename = msg.get('filename')
+        record.extra = {k: v for k, v in msg.items() if k not in cls.FIELDS} or None
+        return record
+    
+    def unpack(self, pages):
+        msg = {'from': self.sender, 'message': self.text, 'type': self.kind}
+        if self.file_id is not None:
+            msg['file_id'] = self.file_id
+            msg['filename'] = self.filename
+        msg['timestamp'] = iso_time(self.ts)
+        if self.page >= 0:
+            msg['page_url'], msg['page_title'] = pages[self.page]
+        if self.extra:
+            msg.update(self.extra)
+        msg['seq'] = self.seq
+        return msg
+    
+    def dump(self):
+        """Slot values for a snapshot"""
+        return [self.seq, self.sender, self.kind, self.text, self.ts, self.page, self.file_id, self.filename, self.extra]
+    
+    @classmethod
+    def load(cls, values):
+        record = cls()
+        (record.seq, sender, kind, record.text, record.ts, record.page,
+         record.file_id, record.filename, record.extra) = values
+        record.sender = sys.intern(sender)
+        record.kind = sys.intern(kind)
+        return record
+
+class SessionRecord:
+    """Compact in-memory session: epoch timestamps, the landing page as a
+    page table index, the unread counter and anything else in extra."""
+    
+    __slots__ = ('name', 'email', 'started', 'last_active', 'unread', 'last_visitor', 'broadcasts', 'page', 'extra')
+    
+    @classmethod
+    def pack(cls, data, pages):
+        record = cls()
+        record.name = 'Anonymous'
+        record.email = ''
+        record.started = record.last_active = time.time()
+        record.unread = 0
+        record.last_visitor = 0.0
+        record.broadcasts = 0
+        record.page = -1
+        record.extra = None
+        record.update(data, pages)
+        return record
+    
+    def update(self, fields, pages):
+        fields = dict(fields)
+        fields.pop('unread', None)
+        for key in ('name', 'email'):
+            if key in fields:
+                setattr(self, key, fields.pop(key))
+        for key in ('started', 'last_active'):
+            if key in fields:
+                setattr(self, key, epoch_time(fields.pop(key)))
+        if 'initial_page' in fields or 'initial_page_title' in fields:
+            url, title = pages[self.page] if self.page >= 0 else (None, None)
+            self.page = pages.intern(fields.pop('initial_page', url), fields.pop('initial_page_title', title))
+        if fields:
+            self.extra = dict(self.extra or {}, **fields)
+    
+    def unpack(self, pages):
+        data = {
+            'name': self.name,
+            'email': self.email,
+            'started': iso_time(self.started),
+            'last_active': iso_time(self.last_active),
+            'unread': self.unread
+        }
+        if self.page >= 0:
+            data['initial_page'], data['initial_page_title'] = pages[self.page]
+        if self.extra:
+            data.update(self.extra)
+        return data
+    
+    def dump(self):
+        return [getattr(self, slot) for slot in self.__slots__]
+    
+    @classmethod
+    def load(cls, values):
+        record = cls()
+        for slot, value in zip(cls.__slots__, values):
+            setattr(record, slot, value)
+        return record
+
+class SortedIndex:
+    """Sorted list of (key, sid) pairs. Lookups bisect; an update moves one
+    entry (a pointer memmove, cheap at thousands of sessions); reading a
+    page costs the page, not the index size."""
+    
+    __slots__ = ('items',)
+    
+    def __init__(self):
+        self.items = []
+    
+    def add(self, key, sid):
+        bisect.insort(self.items, (key, sid))
+    
+    def remove(self, key, sid):
+        i = bisect.bisect_left(self.items, (key, sid))
+        if i < len(self.items) and self.items[i] == (key, sid):
+            del self.items[i]
+    
+    def newest(self, offset, limit):
+        """sids by descending key"""
+        end = len(self.items) - offset
+        return [sid for _, sid in reversed(self.items[max(end - limit, 0):max(end, 0)])]
+    
+    def prefix(self, text, offset, limit):
+        """Distinct sids with a key starting with text, by ascending (first
+        matching) key; offset and limit count sids, not entries"""
+        i = bisect.bisect_left(self.items, (text,))
+        seen = set()
+        sids = []
+        while i < len(self.items) and len(sids) < limit and self.items[i][0].startswith(text):
+            sid = self.items[i][1]
+            if sid not in seen:
+                seen.add(sid)
+                if len(seen) > offset:
+                    sids.append(sid)
+            i += 1
+        return sids
+    
+    def __len__(self):
+        return len(self.items)
+
+
+class ColdLog:
+    """Append-only JSON-lines files holding the trimmed head of message logs.
+    
+    Line N of a session's file is the message with seq N + 1 (its
+    JSON fragment), so a range read is a scan from the top; only history
+    reloads come here.
+    """
+    
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+    
+    def path(self, sid):
+        return os.path.join(self.root, f'{sid}.jsonl')
+    
+    def append(self, sid, fragments):
+        with open(self.path(sid), 'a', encoding='utf-8') as f:
+            f.writelines(fragment + '\n' for fragment in fragments)
+    
+    def read_fragments(self, sid, start, end):
+        try:
+            with open(self.path(sid), encoding='utf-8') as f:
+                return [line.rstrip('\n') for line in itertools.islice(f, start, end)]
+        except FileNotFoundError:
+            return []
+    
+    def read(self, sid, start, end):
+        return [json.loads(fragment) for fragment in self.read_fragments(sid, start, end)]
+    
+    def delete(self, sid):
+        try:
+            os.remove(self.path(sid))
+        except FileNotFoundError:
+            pass
+    
+    def truncate(self, sid, count):
+        """Keep only the first count lines, returning how many were dropped
+        (negative if the file is that many short)"""
+        try:
+            with open(self.path(sid), encoding='utf-8') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return -count
+        if len(lines) > count:
+            fd, tmp = tempfile.mkstemp(dir=self.root, prefix='.tmp-')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.writelines(lines[:count])
+            os.replace(tmp, self.path(sid))
+        return len(lines) - count
+    
+    def paths(self):
+        """Every log file on disk, including any left by a previous process"""
+        return [entry.path for entry in os.scandir(self.root) if entry.name.endswith('.jsonl')]
+
+
+class MemoryStore:
+    """Process-local storage for sessions, message logs and files.
+    
+    Sessions and messages are held as SessionRecord/MessageRecord sharing
+    a per-session PageTable; SortedIndexes order sessions by last_active,
+    by latest unread visitor message and by name/email. Broadcasts are
+    kept once and copied into a session's log by deliver_broadcasts(), on
+    its next read or ahead of its next append. Each session keeps only the
+    tail of its log in memory: trim_messages() (and appends beyond hot_max)
+    move the head to a ColdLog, down to the newest retain messages. Reads spanning the head
+    are served from disk. Up to fragment_max JSON fragments of hot messages
+    are cached per session once read (sessions evicted least recently read
+    first), so repeated history pages and full polls skip re-encoding
+    without every record carrying its encoding.
+    """
+    
+    def __init__(self, cold=None, hot_max=0, retain=0, fragment_max=0):
+        self.lock = threading.RLock()
+        self.cold = cold
+        self.hot_max = hot_max
+        self.retain = retain
+        self.fragment_lock = threading.Lock()
+        self.fragment_cache = collections.OrderedDict()
+        self.fragment_count = 0
+        self.fragment_max = fragment_max
+        self.sessions = {}
+        self.messages = {}
+        self.trimmed = {}
+        self.message_total = 0
+        self.pages = {}
+        self.recent = SortedIndex()
+        self.unread = SortedIndex()
+        self.terms = SortedIndex()
+        self.broadcasts = []
+        self.broadcasts_pruned = 0
+        self.files = {}
+        self.session_files = {}
+        self.blob_refs = {}
+        self.telegram_blobs = {}
+        self.telegram_blob_keys = {}
+        self.telegram_uploads = {}
+    
+    def page_table(self, sid):
+        pages = self.pages.get(sid)
+        if pages is None:
+            pages = self.pages[sid] = PageTable()
+        return pages
+    
+    def index_session(self, sid, record):
+        self.recent.add(record.last_active, sid)
+        if record.unread:
+            self.unread.add(record.last_visitor, sid)
+        for term in {record.name.lower(), record.email.lower()} - {''}:
+            self.terms.add(term, sid)
+    
+    def unindex_session(self, sid, record):
+        self.recent.remove(record.last_active, sid)
+        if record.unread:
+            self.unread.remove(record.last_visitor, sid)
+        for term in {record.name.lower(), record.email.lower()} - {''}:
+            self.terms.remove(term, sid)
+    
+    # Sessions
+    def create_session(self, sid, data):
+        with self.lock:
+            if sid in self.sessions:
+                self.unindex_session(sid, self.sessions[sid])
+            record = self.sessions[sid] = SessionRecord.pack(data, self.page_table(sid))
+            # Only announcements made from now on
+            record.broadcasts = self.broadcast_count()
+            self.index_session(sid, record)
+            self.messages.setdefault(sid, [])
+    
+    def get_session(self, sid):
+        with self.lock:
+            record = self.sessions.get(sid)
+            return record.unpack(self.pages[sid]) if record is not None else None
+    
+    def has_session(self, sid):
+        return sid in self.sessions
+    
+    def update_session(self, sid, **fields):
+        with self.lock:
+            record = self.sessions.get(sid)
+            if record is not None:
+                self.unindex_session(sid, record)
+                record.update(fields, self.pages[sid])
+                self.index_session(sid, record)
+    
+    def touch_session(self, sid, now=None):
+        """Mark a session active now"""
+        with self.lock:
+            record = self.sessions.get(sid)
+            if record is not None:
+                self.recent.remove(record.last_active, sid)
+                record.last_active = now or time.time()
+                self.recent.add(record.last_active, sid)
+    
+    def delete_session(self, sid):
+        with self.lock:
+            record = self.sessions.pop(sid, None)
+            if record is not None:
+                self.unindex_session(sid, record)
+            if sid not in self.messages:
+                self.pages.pop(sid, None)
+    
+    def list_sessions(self, limit=None):
+        """(sid, data) pairs in creation order"""
+        with self.lock:
+            items = list(self.sessions.items())
+        if limit is not None:
+            items = items[:limit]
+        return [(sid, record.unpack(self.pages[sid])) for sid, record in items]
+    
+    def page_sessions(self, view='recent', offset=0, limit=10, query=''):
+        """One page of (sid, data) pairs and whether more follow. Views:
+        'recent' (by last_active), 'unread' (newest unread visitor message
+        first) and 'find' (name/email starting with query)"""
+        with self.lock:
+            if view == 'unread':
+                sids = self.unread.newest(offset, limit + 1)
+            elif view == 'find':
+                sids = self.terms.prefix(query.lower(), offset, limit + 1)
+            else:
+                sids = self.recent.newest(offset, limit + 1)
+            rows = [(sid, self.sessions[sid].unpack(self.pages[sid])) for sid in sids]
+        return rows[:limit], len(rows) > limit
+    
+    def session_ids(self):
+        return list(self.sessions.keys())
+    
+    def session_count(self):
+        return len(self.sessions)
+    
+    def unread_count(self):
+        return len(self.unread)
+    
+    # Messages
+    def append_message(self, sid, msg):
+        """Append to a session log, stamping msg['seq'] and returning it
+        (the new message count)"""
+        with self.lock:
+            # Announcements made before msg take the earlier seqs
+            self.deliver_broadcasts(sid)
+            return self.append_record(sid, msg)
+    
+    def append_record(self, sid, msg):
+        with self.lock:
+            log = self.messages.setdefault(sid, [])
+            seq = self.trimmed.get(sid, 0) + len(log) + 1
+            record = MessageRecord.pack(msg, seq, self.page_table(sid))
+            log.append(record)
+            self.message_total += 1
+            session = self.sessions.get(sid)
+            if session is not None:
+                self.count_unread(sid, session, record)
+            if self.hot_max and len(log) > self.hot_max:
+                self.trim_messages(sid, seq - self.retain)
+            return seq
+    
+    def count_unread(self, sid, session, record):
+        """Visitor messages add to the unread count, an admin message clears it"""
+        if record.sender == 'visitor':
+            if session.unread:
+                self.unread.remove(session.last_visitor, sid)
+            session.unread += 1
+            session.last_visitor = record.ts
+            self.unread.add(session.last_visitor, sid)
+        elif record.sender == 'admin' and session.unread and not (record.extra and record.extra.get('broadcast')):
+            self.unread.remove(session.last_visitor, sid)
+            session.unread = 0
+    
+    def broadcast_count(self):
+        """Announcements ever made, including pruned ones"""
+        return self.broadcasts_pruned + len(self.broadcasts)
+    
+    def append_broadcast(self, msg):
+        """Store an announcement once for every current session, returning its id"""
+        with self.lock:
+            self.broadcasts.append(dict(msg))
+            return self.broadcast_count()
+    
+    def deliver_broadcasts(self, sid):
+        """Copy announcements made since the session started (and not yet
+        copied) into its log, returning how many were added"""
+        record = self.sessions.get(sid)
+        if record is None or record.broadcasts >= self.broadcast_count():
+            return 0
+        with self.lock:
+            pending = self.broadcasts[max(record.broadcasts - self.broadcasts_pruned, 0):]
+            record.broadcasts = self.broadcast_count()
+            for msg in pending:
+                self.append_record(sid, msg)
+            return len(pending)
+    
+    def prune_broadcasts(self, before):
+        """Drop announcements made before epoch seconds before (older than
+        any session that could still need them), returning how many"""
+        with self.lock:
+            count = 0
+            for msg in self.broadcasts:
+                if epoch_time(msg['timestamp']) >= before:
+                    break
+                count += 1
+            del self.broadcasts[:count]
+            self.broadcasts_pruned += count
+            return count
+    
+    def message_count(self, sid):
+        with self.lock:
+            return self.trimmed.get(sid, 0) + len(self.messages.get(sid, ()))
+    
+    def get_messages(self, sid, start=0, end=None):
+        """Messages with seq in (start, end], i.e. log positions [start, end)"""
+        with self.lock:
+            base = self.trimmed.get(sid, 0)
+            hot = self.messages.get(sid, [])[max(start - base, 0):None if end is None else max(end - base, 0)]
+            pages = self.pages.get(sid)
+        hot = [record.unpack(pages) for record in hot]
+        if start < base and self.cold is not None:
+            # The cold file only ever grows past base while the session lives
+            return self.cold.read(sid, start, base if end is None else min(end, base)) + hot
+        return hot
+    
+    def fragments(self, sid, records, pages):
+        """JSON text of records, through the fragment cache"""
+        cache = self.fragment_cache
+        with self.fragment_lock:
+            cached = cache.get(sid)
+            if cached is not None:
+                cache.move_to_end(sid)
+        fragments = [cached.get(record.seq) for record in records] if cached else [None] * len(records)
+        missed = [i for i, fragment in enumerate(fragments) if fragment is None]
+        for i in missed:
+            fragments[i] = encode_json(records[i].unpack(pages))
+        if missed and self.fragment_max:
+            with self.fragment_lock:
+                cached = cache.setdefault(sid, {})
+                cache.move_to_end(sid)
+                for i in missed:
+                    if records[i].seq not in cached:
+                        cached[records[i].seq] = fragments[i]
+                        self.fragment_count += 1
+                # Whole sessions go, least recently read first
+                while self.fragment_count > self.fragment_max:
+                    _, evicted = cache.popitem(last=False)
+                    self.fragment_count -= len(evicted)
+        return fragments
+    
+    def forget_fragments(self, sid, records=None):
+        """Drop cached fragments of records, or of the whole session"""
+        with self.fragment_lock:
+            cached = self.fragment_cache.get(sid)
+            if not cached:
+                return
+            if records is None:
+                del self.fragment_cache[sid]
+                self.fragment_count -= len(cached)
+                return
+            for record in records:
+                if cached.pop(record.seq, None) is not None:
+                    self.fragment_count -= 1
+    
+    def get_fragments(self, sid, start=0, end=None):
+        """(seq, JSON text) pairs for the same range as get_messages()"""
+        with self.lock:
+            base = self.trimmed.get(sid, 0)
+            records = self.messages.get(sid, [])[max(start - base, 0):None if end is None else max(end - base, 0)]
+            pages = self.pages.get(sid)
+        hot = list(zip((record.seq for record in records), self.fragments(sid, records, pages)))
+        if start < base and self.cold is not None:
+            head = self.cold.read_fragments(sid, start, base if end is None else min(end, base))
+            return [(start + i + 1, fragment) for i, fragment in enumerate(head)] + hot
+        return hot
+    
+    def trim_messages(self, sid, upto):
+        """Move messages up to seq upto out of memory, returning how many moved"""
+        if self.cold is None:
+            return 0
+        with self.lock:
+            log = self.messages.get(sid)
+            base = self.trimmed.get(sid, 0)
+            moved = min(upto - base, len(log or ()))
+            if moved <= 0:
+                return 0
+            self.cold.append(sid, self.fragments(sid, log[:moved], self.pages.get(sid)))
+            self.forget_fragments(sid, log[:moved])
+            del log[:moved]
+            self.trimmed[sid] = base + moved
+            return moved
+    
+    def delete_messages(self, sid):
+        with self.lock:
+            trimmed = self.trimmed.pop(sid, 0)
+            self.message_total -= len(self.messages.pop(sid, ())) + trimmed
+            self.forget_fragments(sid)
+            if sid not in self.sessions:
+                self.pages.pop(sid, None)
+            if trimmed and self.cold is not None:
+                self.cold.delete(sid)
+    
+    def total_messages(self):
+        return self.message_total
+    
+    # Files
+    def put_file(self, fid, record):
+        with self.lock:
+            self.files[fid] = record
+            if record.get('sid'):
+                self.session_files.setdefault(record['sid'], []).append(fid)
+            for digest in file_blobs(record):
+                self.blob_refs[digest] = self.blob_refs.get(digest, 0) + 1
+    
+    def set_file_variants(self, fid, variants):
+        """Attach image variants to a file record; False if it is already gone"""
+        with self.lock:
+            record = self.files.get(fid)
+            if record is None:
+                return False
+            record['variants'] = variants
+            for variant in variants.values():
+                self.blob_refs[variant['blob']] = self.blob_refs.get(variant['blob'], 0) + 1
+            return True
+    
+    def get_file(self, fid):
+        return self.files.get(fid)
+    
+    def delete_file(self, fid):
+        """Remove a file record, returning it (or None)"""
+        with self.lock:
+            record = self.files.pop(fid, None)
+            for digest in file_blobs(record) if record else ():
+                self.blob_refs[digest] -= 1
+                if not self.blob_refs[digest]:
+                    del self.blob_refs[digest]
+            return record
+    
+    def delete_session_files(self, sid):
+        """Remove every file record a session owns, returning them"""
+        with self.lock:
+            fids = self.session_files.pop(sid, [])
+            return [record for record in map(self.delete_file, fids) if record]
+    
+    def blob_in_use(self, digest):
+        return digest in self.blob_refs
+    
+    def file_count(self):
+        return len(self.files)
+    
+    # Telegram file cache: file_unique_id -> (blob, size), and
+    # blob -> {kind: file_id} for re-sending without an upload
+    def get_telegram_blob(self, unique_id):
+        return self.telegram_blobs.get(unique_id)
+    
+    def put_telegram_blob(self, unique_id, digest, size):
+        with self.lock:
+            self.telegram_blobs[unique_id] = (digest, size)
+            self.telegram_blob_keys.setdefault(digest, set()).add(unique_id)
+    
+    def get_telegram_file_id(self, digest, kind):
+        return self.telegram_uploads.get(digest, {}).get(kind)
+    
+    def put_telegram_file_id(self, digest, kind, file_id):
+        with self.lock:
+            self.telegram_uploads.setdefault(digest, {})[kind] = file_id
+    
+    def forget_blob(self, digest):
+        """Drop cache entries pointing at a reclaimed blob"""
+        with self.lock:
+            self.telegram_uploads.pop(digest, None)
+            for unique_id in self.telegram_blob_keys.pop(digest, ()):
+                self.telegram_blobs.pop(unique_id, None)
+
+
+class SQLiteStore:
+    """SQLite (WAL) storage shared by every worker process on the host.
+    
+    Messages are keyed by (sid, pos) so appends, counts and poll() range
+    reads are primary-key lookups; sessions are indexed by 'started' for cleanup
+    and by last_active, unread visitor messages and name/email for /sessions.
+    """
+    
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS sessions ("
+        " sid TEXT PRIMARY KEY, started TEXT NOT NULL, data TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS sessions_started ON sessions (started)",
+        "CREATE TABLE IF NOT EXISTS messages ("
+        " sid TEXT NOT NULL, pos INTEGER NOT NULL, data TEXT NOT NULL,"
+        " PRIMARY KEY (sid, pos)) WITHOUT ROWID",
+        "CREATE TABLE IF NOT EXISTS files ("
+        " fid TEXT PRIMARY KEY, sid TEXT, blob TEXT, data TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS broadcasts (id INTEGER PRIMARY KEY, data TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS file_variants ("
+        " fid TEXT NOT NULL, name TEXT NOT NULL, blob TEXT NOT NULL,"
+        " PRIMARY KEY (fid, name)) WITHOUT ROWID",
+        "CREATE INDEX IF NOT EXISTS file_variants_blob ON file_variants (blob)",
+        "CREATE TABLE IF NOT EXISTS telegram_blobs ("
+        " unique_id TEXT PRIMARY KEY, blob TEXT NOT NULL, size INTEGER NOT NULL) WITHOUT ROWID",
+        "CREATE INDEX IF NOT EXISTS telegram_blobs_blob ON telegram_blobs (blob)",
+        "CREATE TABLE IF NOT EXISTS telegram_uploads ("
+        " blob TEXT NOT NULL, kind TEXT NOT NULL, file_id TEXT NOT NULL,"
+        " PRIMARY KEY (blob, kind)) WITHOUT ROWID",
+        "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL) WITHOUT ROWID",
+    )
+    # Row counts kept in 'counters' by triggers, so health checks never COUNT(*)
+    COUNTED = ('sessions', 'messages', 'files')
+    # Columns added after the first release, created on older databases
+    COLUMNS = {
+        'files': (('sid', 'TEXT'), ('blob', 'TEXT')),
+        'sessions': (
+            ('last_active', 'REAL'), ('unread', 'INTEGER NOT NULL DEFAULT 0'), ('last_visitor', 'REAL'),
+            ('name_key', 'TEXT'), ('email_key', 'TEXT'), ('broadcast_seen', 'INTEGER NOT NULL DEFAULT 0')
+        ),
+    }
+    INDEXES = (
+        "CREATE INDEX IF NOT EXISTS files_sid ON files (sid)",
+        "CREATE INDEX IF NOT EXISTS files_blob ON files (blob)",
+        "CREATE INDEX IF NOT EXISTS sessions_last_active ON sessions (last_active)",
+        "CREATE INDEX IF NOT EXISTS sessions_unread ON sessions (last_visitor) WHERE unread > 0",
+        "CREATE INDEX IF NOT EXISTS sessions_name ON sessions (name_key)",
+        "CREATE INDEX IF NOT EXISTS sessions_email ON sessions (email_key)",
+    )
+    
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        conn = self.conn()
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+        for table, added in self.COLUMNS.items():
+            columns = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+            for column, kind in added:
+                if column not in columns:
+                    conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {kind}')
+        # Sessions stored before the index columns existed
+        for sid, data in conn.execute('SELECT sid, data FROM sessions WHERE last_active IS NULL').fetchall():
+            data = json.loads(data)
+            conn.execute(
+                'UPDATE sessions SET last_active = ?, name_key = ?, email_key = ? WHERE sid = ?',
+                (epoch_time(data['last_active']), *self.search_keys(data), sid)
+            )
+        for statement in self.INDEXES:
+            conn.execute(statement)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for table in self.COUNTED:
+                if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = ?",
+                                (f'{table}_counted',)).fetchone():
+                    continue
+                # Seeded in the same transaction, so no insert slips between count and trigger
+                conn.execute(f"INSERT OR REPLACE INTO counters (name, value) SELECT '{table}', COUNT(*) FROM {table}")
+                conn.execute(f"CREATE TRIGGER {table}_counted AFTER INSERT ON {table} BEGIN"
+                             f" UPDATE counters SET value = value + 1 WHERE name = '{table}'; END")
+                conn.execute(f"CREATE TRIGGER {table}_uncounted AFTER DELETE ON {table} BEGIN"
+                             f" UPDATE counters SET value = value - 1 WHERE name = '{table}'; END")
+            if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'unread_counted'").fetchone():
+                # Sessions with unread > 0, for unread_count()
+                conn.execute("INSERT OR REPLACE INTO counters (name, value)"
+                             " SELECT 'unread', COUNT(*) FROM sessions WHERE unread > 0")
+                conn.execute("CREATE TRIGGER unread_counted AFTER INSERT ON sessions WHEN NEW.unread > 0 BEGIN"
+                             " UPDATE counters SET value = value + 1 WHERE name = 'unread'; END")
+                conn.execute("CREATE TRIGGER unread_uncounted AFTER DELETE ON sessions WHEN OLD.unread > 0 BEGIN"
+                             " UPDATE counters SET value = value - 1 WHERE name = 'unread'; END")
+                conn.execute("CREATE TRIGGER unread_changed AFTER UPDATE OF unread ON sessions"
+                             " WHEN (OLD.unread > 0) != (NEW.unread > 0) BEGIN"
+                             " UPDATE counters SET value = value + (NEW.unread > 0) - (OLD.unread > 0)"
+                             " WHERE name = 'unread'; END")
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    
+    def counter(self, name):
+        return self.conn().execute('SELECT value FROM counters WHERE name = ?', (name,)).fetchone()[0]
+    
+    def conn(self):
+        """Per-thread connection in autocommit mode"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            # INSERT OR REPLACE then fires the delete trigger for the row it replaces
+            conn.execute('PRAGMA recursive_triggers=ON')
+            self.local.conn = conn
+        return conn
+    
+    # Sessions
+    def encode_session(self, data):
+        data = dict(data)
+        data.pop('unread', None)
+        for key in ('started', 'last_active'):
+            if key in data:
+                data[key] = iso_time(data[key])
+        return data
+    
+    def search_keys(self, data):
+        return data.get('name', '').lower(), data.get('email', '').lower()
+    
+    def create_session(self, sid, data):
+        data = self.encode_session(data)
+        # broadcast_seen: only announcements made from now on
+        self.conn().execute(
+            'INSERT OR REPLACE INTO sessions (sid, started, data, last_active, name_key, email_key, broadcast_seen)'
+            ' VALUES (?, ?, ?, ?, ?, ?, (SELECT COALESCE(MAX(id), 0) FROM broadcasts))',
+            (sid, data['started'], json.dumps(data), epoch_time(data['last_active']), *self.search_keys(data))
+        )
+    
+    def get_session(self, sid):
+        row = self.conn().execute('SELECT data, unread FROM sessions WHERE sid = ?', (sid,)).fetchone()
+        return dict(json.loads(row[0]), unread=row[1]) if row else None
+    
+    def has_session(self, sid):
+        return self.conn().execute('SELECT 1 FROM sessions WHERE sid = ?', (sid,)).fetchone() is not None
+    
+    def update_session(self, sid, **fields):
+        conn = self.conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT data FROM sessions WHERE sid = ?', (sid,)).fetchone()
+            if row:
+                data = json.loads(row[0])
+                data.update(self.encode_session(fields))
+                conn.execute(
+                    'UPDATE sessions SET data = ?, last_active = ?, name_key = ?, email_key = ? WHERE sid = ?',
+                    (json.dumps(data), epoch_time(data['last_active']), *self.search_keys(data), sid)
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    
+    def touch_session(self, sid):
+        """Mark a session active now"""
+        now = time.time()
+        self.conn().execute(
+            "UPDATE sessions SET data = json_set(data, '$.last_active', ?), last_active = ? WHERE sid = ?",
+            (iso_time(now), now, sid)
+        )
+    
+    def delete_session(self, sid):
+        self.conn().execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+    
+    def list_sessions(self, limit=None):
+        """(sid, data) pairs in creation order"""
+        rows = self.conn().execute(
+            'SELECT sid, data, unread FROM sessions ORDER BY rowid LIMIT ?',
+            (-1 if limit is None else limit,)
+        )
+        return [(sid, dict(json.loads(data), unread=unread)) for sid, data, unread in rows]
+    
+    def page_sessions(self, view='recent', offset=0, limit=10, query=''):
+        """One page of (sid, data) pairs and whether more follow (see MemoryStore)"""
+        if view == 'unread':
+            sql = 'SELECT sid, data, unread FROM sessions WHERE unread > 0 ORDER BY last_visitor DESC'
+            params = ()
+        elif view == 'find':
+            low = query.lower()
+            high = low + '\U0010ffff'
+            sql = (
+                'SELECT sid, data, unread FROM sessions WHERE sid IN ('
+                ' SELECT sid FROM sessions WHERE name_key >= ? AND name_key < ?'
+                ' UNION SELECT sid FROM sessions WHERE email_key >= ? AND email_key < ?)'
+                ' ORDER BY name_key'
+            )
+            params = (low, high, low, high)
+        else:
+            sql = 'SELECT sid, data, unread FROM sessions ORDER BY last_active DESC'
+            params = ()
+        rows = self.conn().execute(f'{sql} LIMIT ? OFFSET ?', (*params, limit + 1, offset)).fetchall()
+        return [(sid, dict(json.loads(data), unread=unread)) for sid, data, unread in rows[:limit]], len(rows) > limit
+    
+    def session_ids(self):
+        return [row[0] for row in self.conn().execute('SELECT sid FROM sessions ORDER BY rowid')]
+    
+    def session_count(self):
+        return self.counter('sessions')
+    
+    def unread_count(self):
+        return self.counter('unread')
+    
+    # Messages
+    def append_message(self, sid, msg):
+        """Append to a session log, stamping msg['seq'] and returning it
+        (the new message count)"""
+        conn = self.conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Announcements made before msg take the earlier seqs
+            self.insert_broadcasts(conn, sid)
+            seq = self.insert_message(conn, sid, msg)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return seq
+    
+    def insert_message(self, conn, sid, msg):
+        """append_message() body, inside the caller's transaction"""
+        pos = conn.execute(
+            'SELECT COALESCE(MAX(pos) + 1, 0) FROM messages WHERE sid = ?', (sid,)
+        ).fetchone()[0]
+        ts = epoch_time(msg.get('timestamp', time.time()))
+        conn.execute(
+            'INSERT INTO messages (sid, pos, data) VALUES (?, ?, ?)',
+            (sid, pos, encode_json(dict(msg, timestamp=iso_time(ts), seq=pos + 1)))
+        )
+        # Visitor messages add to the unread count, an admin reply clears it
+        if msg.get('from') == 'visitor':
+            conn.execute(
+                'UPDATE sessions SET unread = unread + 1, last_visitor = ? WHERE sid = ?', (ts, sid)
+            )
+        elif msg.get('from') == 'admin' and not msg.get('broadcast'):
+            conn.execute('UPDATE sessions SET unread = 0 WHERE sid = ? AND unread > 0', (sid,))
+        return pos + 1
+    
+    def append_broadcast(self, msg):
+        """Store an announcement once for every current session, returning its id"""
+        return self.conn().execute('INSERT INTO broadcasts (data) VALUES (?)', (json.dumps(msg),)).lastrowid
+    
+    def deliver_broadcasts(self, sid):
+        """Copy announcements made since the session started (and not yet
+        copied) into its log, returning how many were added"""
+        conn = self.conn()
+        pending = conn.execute(
+            'SELECT 1 FROM broadcasts WHERE id > (SELECT broadcast_seen FROM sessions WHERE sid = ?) LIMIT 1', (sid,)
+        ).fetchone()
+        if not pending:
+            return 0
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            count = self.insert_broadcasts(conn, sid)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return count
+    
+    def insert_broadcasts(self, conn, sid):
+        """deliver_broadcasts() body, inside the caller's transaction"""
+        rows = conn.execute(
+            'SELECT id, data FROM broadcasts'
+            ' WHERE id > (SELECT broadcast_seen FROM sessions WHERE sid = ?) ORDER BY id', (sid,)
+        ).fetchall()
+        for _, data in rows:
+            self.insert_message(conn, sid, json.loads(data))
+        if rows:
+            conn.execute('UPDATE sessions SET broadcast_seen = ? WHERE sid = ?', (rows[-1][0], sid))
+        return len(rows)
+    
+    def prune_broadcasts(self, before):
+        """Drop announcements made before epoch seconds before, returning how many"""
+        # The newest row always stays: its id is what new sessions start from
+        return self.conn().execute(
+            "DELETE FROM broadcasts WHERE id < (SELECT MAX(id) FROM broadcasts)"
+            " AND json_extract(data, '$.timestamp') < ?", (before,)
+        ).rowcount
+    
+    def message_count(self, sid):
+        return self.conn().execute(
+            'SELECT COALESCE(MAX(pos) + 1, 0) FROM messages WHERE sid = ?', (sid,)
+        ).fetchone()[0]
+    
+    def get_messages(self, sid, start=0, end=None):
+        """Messages with seq in (start, end], i.e. log positions [start, end)"""
+        rows = self.conn().execute(
+            'SELECT pos, data FROM messages WHERE sid = ? AND pos >= ? AND pos < ? ORDER BY pos',
+            (sid, start, end if end is not None else 2 ** 62)
+        )
+        # Rows written before messages carried their seq
+        return [dict(json.loads(data), seq=pos + 1) for pos, data in rows]
+    
+    def get_fragments(self, sid, start=0, end=None):
+        """(seq, JSON text) pairs for the same range as get_messages(); the
+        stored rows already are the encoding"""
+        rows = self.conn().execute(
+            'SELECT pos, data FROM messages WHERE sid = ? AND pos >= ? AND pos < ? ORDER BY pos',
+            (sid, start, end if end is not None else 2 ** 62)
+        )
+        # A quote inside a string value is escaped, so '"seq":' only matches the key
+        return [
+            (pos + 1, data if '"seq":' in data else encode_json(dict(json.loads(data), seq=pos + 1)))
+            for pos, data in rows
+        ]
+    
+    def trim_messages(self, sid, upto):
+        """No-op: the whole log already lives on disk"""
+        return 0
+    
+    def delete_messages(self, sid):
+        self.conn().execute('DELETE FROM messages WHERE sid = ?', (sid,))
+    
+    def total_messages(self):
+        return self.counter('messages')
+    
+    # Files
+    def put_file(self, fid, record):
+        self.conn().execute(
+            'INSERT OR REPLACE INTO files (fid, sid, blob, data) VALUES (?, ?, ?, ?)',
+            (fid, record.get('sid'), record.get('blob'), json.dumps(record))
+        )
+    
+    def set_file_variants(self, fid, variants):
+        """Attach image variants to a file record; False if it is already gone"""
+        conn = self.conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            updated = conn.execute(
+                "UPDATE files SET data = json_set(data, '$.variants', json(?)) WHERE fid = ?",
+                (json.dumps(variants), fid)
+            ).rowcount
+            if updated:
+                # Indexed separately so blob_in_use() covers variant blobs too
+                conn.executemany(
+                    'INSERT OR REPLACE INTO file_variants (fid, name, blob) VALUES (?, ?, ?)',
+                    [(fid, name, variant['blob']) for name, variant in variants.items()]
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return bool(updated)
+    
+    def get_file(self, fid):
+        row = self.conn().execute('SELECT data FROM files WHERE fid = ?', (fid,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def delete_file(self, fid):
+        """Remove a file record, returning it (or None)"""
+        conn = self.conn()
+        conn.execute('DELETE FROM file_variants WHERE fid = ?', (fid,))
+        row = conn.execute('DELETE FROM files WHERE fid = ? RETURNING data', (fid,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def delete_session_files(self, sid):
+        """Remove every file record a session owns, returning them"""
+        conn = self.conn()
+        conn.execute('DELETE FROM file_variants WHERE fid IN (SELECT fid FROM files WHERE sid = ?)', (sid,))
+        rows = conn.execute('DELETE FROM files WHERE sid = ? RETURNING data', (sid,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+    
+    def blob_in_use(self, digest):
+        return self.conn().execute(
+            'SELECT 1 FROM files WHERE blob = ? UNION ALL SELECT 1 FROM file_variants WHERE blob = ? LIMIT 1',
+            (digest, digest)
+        ).fetchone() is not None
+    
+    def file_count(self):
+        return self.counter('files')
+    
+    # Telegram file cache
+    def get_telegram_blob(self, unique_id):
+        row = self.conn().execute(
+            'SELECT blob, size FROM telegram_blobs WHERE unique_id = ?', (unique_id,)
+        ).fetchone()
+        return tuple(row) if row else None
+    
+    def put_telegram_blob(self, unique_id, digest, size):
+        self.conn().execute(
+            'INSERT OR REPLACE INTO telegram_blobs (unique_id, blob, size) VALUES (?, ?, ?)',
+            (unique_id, digest, size)
+        )
+    
+    def get_telegram_file_id(self, digest, kind):
+        row = self.conn().execute(
+            'SELECT file_id FROM telegram_uploads WHERE blob = ? AND kind = ?', (digest, kind)
+        ).fetchone()
+        return row[0] if row else None
+    
+    def put_telegram_file_id(self, digest, kind, file_id):
+        self.conn().execute(
+            'INSERT OR REPLACE INTO telegram_uploads (blob, kind, file_id) VALUES (?, ?, ?)',
+            (digest, kind, file_id)
+        )
+    
+    def forget_blob(self, digest):
+        """Drop cache entries pointing at a reclaimed blob"""
+        conn = self.conn()
+        conn.execute('DELETE FROM telegram_blobs WHERE blob = ?', (digest,))
+        conn.execute('DELETE FROM telegram_uploads WHERE blob = ?', (digest,))
+
+
+class Journal:
+    """Append-only JSON-lines log of store mutations, in numbered segments,
+    next to the latest compacted snapshot.
+    
+    Every entry is written through to the OS as it is appended, so a killed
+    process loses nothing; fsync ('always', 'interval' or 'never') only
+    decides what a power loss can take.
+    """
+    
+    def __init__(self, root, fsync='interval'):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.file = None
+        self.segment = 0
+        self.size = 0
+        self.dirty = False
+        self.entries = 0
+        self.snapshots = 0
+        self.last_snapshot_ms = 0.0
+    
+    def segment_path(self, segment):
+        return os.path.join(self.root, f'journal-{segment:06d}.jsonl')
+    
+    def segments(self):
+        return sorted(int(os.path.basename(path)[8:-6]) for path in glob.glob(os.path.join(self.root, 'journal-*.jsonl')))
+    
+    def open(self, segment):
+        """Continue in a fresh segment (a torn tail is never appended to)"""
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+            self.file = open(self.segment_path(segment), 'a', encoding='utf-8')
+            self.segment = segment
+            self.size = 0
+    
+    def append(self, entry):
+        line = encode_json(entry) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            if self.fsync == 'always':
+                os.fsync(self.file.fileno())
+            else:
+                self.dirty = True
+            self.size += len(line)
+            self.entries += 1
+    
+    def sync(self):
+        with self.lock:
+            if self.dirty and self.fsync == 'interval':
+                os.fsync(self.file.fileno())
+            self.dirty = False
+    
+    def read(self, segment):
+        """Entries of a segment, stopping at a torn last line"""
+        with open(self.segment_path(segment), encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logger.warning(f"Journal segment {segment} ends in a torn entry, ignored")
+                    return
+    
+    def load_snapshot(self):
+        try:
+            with open(os.path.join(self.root, 'snapshot.json'), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+    
+    def write_snapshot(self, state):
+        """Replace the snapshot atomically, then drop the segments it covers"""
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix='.tmp-')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(state, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.root, 'snapshot.json'))
+        for segment in self.segments():
+            if segment < state['journal']:
+                os.remove(self.segment_path(segment))
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'fsync': self.fsync,
+                'segment': self.segment,
+                'segment_bytes': self.size,
+                'entries': self.entries,
+                'snapshots': self.snapshots,
+                'last_snapshot_ms': self.last_snapshot_ms
+            }
+
+
+class JournaledStore(MemoryStore):
+    """MemoryStore that survives restarts: each mutation is journaled
+    (write-ahead, under the store lock, so the journal has the order the
+    store applied) and recover() rebuilds state from the snapshot plus the
+    journal tail. A background thread fsyncs and, once the tail passes
+    SNAPSHOT_JOURNAL_BYTES or SNAPSHOT_INTERVAL, compacts it into a new
+    snapshot, which bounds how much a restart replays.
+    
+    Entries are the public method calls themselves, with clock reads
+    (touch, message timestamps) made explicit so replay is deterministic.
+    Touches are journaled at most once per SWEEP_INTERVAL per session.
+    Moving messages to the ColdLog is the exception: it is journaled as its
+    effect ('trimmed') because replay must not write the ColdLog again.
+    """
+    
+    def __init__(self, journal, cold=None, hot_max=0, retain=0, fragment_max=0):
+        super().__init__(cold, hot_max, retain, fragment_max)
+        self.journal = journal
+        self.touches = {}
+        self.replaying = False
+        self.muted = 0
+        self.recovered_entries = 0
+        self.recovery_ms = 0.0
+    
+    def command(self, method, /, *args, **kwargs):
+        with self.lock:
+            # Mutations made by another one (delete_session_files -> delete_file) replay with it
+            if not (self.muted or self.replaying):
+                self.journal.append([method, args, kwargs] if kwargs else [method, args])
+            self.muted += 1
+            try:
+                return getattr(MemoryStore, method)(self, *args, **kwargs)
+            finally:
+                self.muted -= 1
+    
+    def create_session(self, sid, data):
+        return self.command('create_session', sid, data)
+    
+    def update_session(self, sid, **fields):
+        return self.command('update_session', sid, **fields)
+    
+    def touch_session(self, sid, now=None):
+        # Every poll and stream tick touches; last_active only feeds idle
+        # expiry and /sessions order, so one journaled touch per session
+        # per SWEEP_INTERVAL is enough (replay is at most that far behind)
+        now = now or time.time()
+        with self.lock:
+            if now - self.touches.get(sid, 0) < SWEEP_INTERVAL:
+                return MemoryStore.touch_session(self, sid, now)
+            self.touches[sid] = now
+            return self.command('touch_session', sid, now)
+    
+    def delete_session(self, sid):
+        with self.lock:
+            self.touches.pop(sid, None)
+            return self.command('delete_session', sid)
+    
+    def append_message(self, sid, msg):
+        if 'timestamp' not in msg:
+            msg = dict(msg, timestamp=time.time())
+        return self.command('append_message', sid, msg)
+    
+    def append_broadcast(self, msg):
+        return self.command('append_broadcast', msg)
+    
+    def deliver_broadcasts(self, sid):
+        # Checked first: every poll calls this, and almost always for nothing
+        record = self.sessions.get(sid)
+        if record is None or record.broadcasts >= self.broadcast_count():
+            return 0
+        return self.command('deliver_broadcasts', sid)
+    
+    def prune_broadcasts(self, before):
+        return self.command('prune_broadcasts', before)
+    
+    def trim_messages(self, sid, upto):
+        with self.lock:
+            moved = super().trim_messages(sid, upto)
+            if moved and not self.replaying:
+                self.journal.append(['trimmed', [sid, moved]])
+            return moved
+    
+    def delete_messages(self, sid):
+        return self.command('delete_messages', sid)
+    
+    def put_file(self, fid, record):
+        return self.command('put_file', fid, record)
+    
+    def set_file_variants(self, fid, variants):
+        return self.command('set_file_variants', fid, variants)
+    
+    def delete_file(self, fid):
+        return self.command('delete_file', fid)
+    
+    def delete_session_files(self, sid):
+        return self.command('delete_session_files', sid)
+    
+    def put_telegram_blob(self, unique_id, digest, size):
+        return self.command('put_telegram_blob', unique_id, digest, size)
+    
+    def put_telegram_file_id(self, digest, kind, file_id):
+        return self.command('put_telegram_file_id', digest, kind, file_id)
+    
+    def forget_blob(self, digest):
+        return self.command('forget_blob', digest)
+    
+    # Recovery
+    def recover(self):
+        """Load the snapshot, replay the journal after it and open a new segment"""
+        started = time.monotonic()
+        snapshot = self.journal.load_snapshot()
+        first = 0
+        if snapshot is not None:
+            self.restore(snapshot)
+            first = snapshot['journal']
+        
+        segments = [segment for segment in self.journal.segments() if segment >= first]
+        # Trims arrive as their own entries, so appends must not trim again
+        hot_max, self.hot_max = self.hot_max, 0
+        self.replaying = True
+        try:
+            for segment in segments:
+                for entry in self.journal.read(segment):
+                    self.replay(entry)
+                    self.recovered_entries += 1
+        finally:
+            self.replaying = False
+            self.hot_max = hot_max
+        self.reconcile_cold()
+        self.journal.open(max(segments + [first]) + 1)
+        
+        self.recovery_ms = round((time.monotonic() - started) * 1000, 1)
+        logger.info(
+            f"Recovered {len(self.sessions)} sessions, {self.message_total} messages "
+            f"({self.recovered_entries} journal entries) in {self.recovery_ms} ms"
+        )
+    
+    def replay(self, entry):
+        name, args = entry[0], entry[1]
+        kwargs = entry[2] if len(entry) > 2 else {}
+        try:
+            if name == 'trimmed':
+                sid, moved = args
+                del self.messages.get(sid, [])[:moved]
+                self.trimmed[sid] = self.trimmed.get(sid, 0) + moved
+            else:
+                getattr(MemoryStore, name)(self, *args, **kwargs)
+        except Exception as e:
+            logger.error(f"Journal replay of {name} failed: {e}")
+    
+    def reconcile_cold(self):
+        """A ColdLog append whose 'trimmed' entry never reached the journal
+        left those messages in both places; the hot copy wins"""
+        if self.cold is None:
+            return
+        for sid, count in self.trimmed.items():
+            extra = self.cold.truncate(sid, count)
+            if extra > 0:
+                logger.warning(f"History of {sid}: dropped {extra} lines the journal never recorded as trimmed")
+            elif extra < 0:
+                logger.error(f"History of {sid}: {-extra} trimmed messages missing from {self.cold.root}")
+    
+    def restore(self, state):
+        for sid, pages in state['pages'].items():
+            table = self.pages[sid] = PageTable()
+            table.pages = [tuple(page) for page in pages]
+        for sid, values in state['sessions'].items():
+            record = self.sessions[sid] = SessionRecord.load(values)
+            self.index_session(sid, record)
+        for sid, log in state['messages'].items():
+            self.page_table(sid)
+            self.messages[sid] = [MessageRecord.load(values) for values in log]
+            self.message_total += len(log)
+        self.trimmed = state['trimmed']
+        self.message_total += sum(self.trimmed.values())
+        self.broadcasts = state['broadcasts']
+        self.broadcasts_pruned = state.get('broadcasts_pruned', 0)
+        self.session_files = state['session_files']
+        for fid, record in state['files'].items():
+            self.files[fid] = record
+            for digest in file_blobs(record):
+                self.blob_refs[digest] = self.blob_refs.get(digest, 0) + 1
+        for unique_id, (digest, size) in state['telegram_blobs'].items():
+            MemoryStore.put_telegram_blob(self, unique_id, digest, size)
+        self.telegram_uploads = state['telegram_uploads']
+    
+    # Compaction
+    def snapshot(self):
+        """Write a snapshot of the current state and start a new segment.
+        
+        Only the copy is taken under the store lock; message records never
+        change once made, so they are serialized after it is released.
+        """
+        started = time.monotonic()
+        with self.lock:
+            state = {
+                'sessions': {sid: record.dump() for sid, record in self.sessions.items()},
+                'pages': {sid: list(table.pages) for sid, table in self.pages.items()},
+                'messages': {sid: list(log) for sid, log in self.messages.items()},
+                'trimmed': dict(self.trimmed),
+                'broadcasts': list(self.broadcasts),
+                'broadcasts_pruned': self.broadcasts_pruned,
+                'files': {fid: dict(record) for fid, record in self.files.items()},
+                'session_files': {sid: list(fids) for sid, fids in self.session_files.items()},
+                'telegram_blobs': dict(self.telegram_blobs),
+                'telegram_uploads': {digest: dict(kinds) for digest, kinds in self.telegram_uploads.items()},
+                'journal': self.journal.segment + 1
+            }
+            self.journal.open(state['journal'])
+        state['messages'] = {sid: [record.dump() for record in log] for sid, log in state['messages'].items()}
+        self.journal.write_snapshot(state)
+        with self.journal.lock:
+            self.journal.snapshots += 1
+            self.journal.last_snapshot_ms = round((time.monotonic() - started) * 1000, 1)
+    
+    def start(self):
+        threading.Thread(target=self.run, name='journal', daemon=True).start()
+    
+    def run(self):
+        last_snapshot = time.monotonic()
+        while True:
+            time.sleep(JOURNAL_FSYNC_INTERVAL)
+            try:
+                self.journal.sync()
+                due = time.monotonic() - last_snapshot > SNAPSHOT_INTERVAL
+                if self.journal.size > SNAPSHOT_JOURNAL_BYTES or (due and self.journal.size):
+                    self.snapshot()
+                    last_snapshot = time.monotonic()
+            except Exception as e:
+                logger.error(f"Journal error: {e}")
+
+
+def create_store():
+    if STORAGE_BACKEND == 'sqlite':
+        logger.info(f"Storage: SQLite ({SQLITE_PATH})")
+        return SQLiteStore(SQLITE_PATH)
+    if JOURNAL_DIR:
+        logger.info(f"Storage: memory, journaled to {JOURNAL_DIR} (fsync: {JOURNAL_FSYNC})")
+        journaled = JournaledStore(Journal(JOURNAL_DIR, JOURNAL_FSYNC), ColdLog(HISTORY_DIR), MESSAGE_HOT_MAX, MESSAGE_RETAIN,
+                                   FRAGMENT_CACHE_SIZE)
+        journaled.recover()
+        journaled.start()
+        return journaled
+    return MemoryStore(ColdLog(HISTORY_DIR), MESSAGE_HOT_MAX, MESSAGE_RETAIN, FRAGMENT_CACHE_SIZE)
+
+store = create_store()
+
+
+class BlobStore:
+    """Content-addressed file bodies on local disk, named by SHA-256.
+    
+    Identical uploads share one file; writes go through a temp file and
+    os.replace so readers never see a partial blob.
+    """
+    
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+    
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:])
+    
+    def put(self, data):
+        """Store bytes, returning their digest"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if os.path.exists(path):
+            self.touch(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.root, prefix='.tmp-')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return digest
+    
+    def put_stream(self, stream, limit=None):
+        """Copy a file-like object to disk chunk by chunk, returning (digest, size).
+        
+        Raises ValueError once more than limit bytes have been read.
+        """
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = stream.read(64 * 1024)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    if limit is not None and f.tell() > limit:
+                        raise ValueError('File too large')
+            return self.put_path(tmp)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    
+    def put_path(self, src):
+        """Move a finished file into the store, returning (digest, size)"""
+        sha = hashlib.sha256()
+        size = 0
+        with open(src, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                sha.update(chunk)
+                size += len(chunk)
+        digest = sha.hexdigest()
+        path = self.path(digest)
+        if os.path.exists(path):
+            os.remove(src)
+            self.touch(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.move(src, path)
+        return digest, size
+    
+    def touch(self, path):
+        """Mark a deduplicated blob as freshly referenced (see reclaim)"""
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+    
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+    
+    def read(self, digest):
+        with open(self.path(digest), 'rb') as f:
+            return f.read()
+    
+    def delete(self, digest):
+        try:
+            os.remove(self.path(digest))
+        except FileNotFoundError:
+            pass
+    
+    def reclaim(self, digest, min_age=60):
+        """Delete an unreferenced blob, returning the bytes freed.
+        
+        Blobs touched in the last min_age seconds are kept: a concurrent
+        upload may have just deduplicated into them and not yet registered
+        its file record. At worst that leaves an orphan, never a dangling record.
+        """
+        path = self.path(digest)
+        try:
+            stat = os.stat(path)
+            if time.time() - stat.st_mtime < min_age:
+                return 0
+            os.remove(path)
+            return stat.st_size
+        except FileNotFoundError:
+            return 0
+
+blobs = BlobStore(BLOB_DIR)
+
+
+class ImagePipeline:
+    """Bounded worker pool that renders a downscaled 'display' copy and a
+    'thumb' of every stored image, stripped of EXIF/ICC metadata.
+    
+    Variants are ordinary blobs listed under the file record's 'variants';
+    the original is never touched, so a dropped or failed job only means
+    get_file() keeps serving the original. Either way finish() leaves
+    'variants' set (empty when there are none), which is what tells
+    when_ready() the job is over.
+    """
+    
+    TYPES = ('image/jpeg', 'image/png', 'image/webp', 'image/bmp', 'image/tiff')
+    SIZES = (('display', IMAGE_DISPLAY_MAX), ('thumb', IMAGE_THUMB_MAX))
+    
+    def __init__(self, workers, maxsize):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.lock = threading.Lock()
+        self.waiters = {}
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.run_total = 0.0
+        for i in range(workers):
+            threading.Thread(target=self.work, name=f'image-{i}', daemon=True).start()
+    
+    def accepts(self, mime_type):
+        # GIFs are left alone so animations survive
+        return Image is not None and mime_type in self.TYPES
+    
+    def submit(self, fid):
+        """Queue fid for rendering; returns False (and drops it) when the queue is full"""
+        try:
+            self.queue.put_nowait(fid)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            logger.warning(f"Image queue full, serving original for {fid}")
+            self.finish(fid, None)
+            return False
+        with self.lock:
+            self.submitted += 1
+        return True
+    
+    def when_ready(self, fid, callback):
+        """Call callback(variants) once fid is rendered, or callback(None)
+        if it cannot be; runs on an image worker, so keep it short"""
+        with self.lock:
+            record = store.get_file(fid)
+            if record is None or 'variants' in record or not self.accepts(record.get('mime')):
+                variants = record.get('variants') or None if record else None
+            else:
+                self.waiters.setdefault(fid, []).append(callback)
+                return
+        callback(variants)
+    
+    def finish(self, fid, variants):
+        with self.lock:
+            # An empty dict marks a dropped or failed job as done, so a
+            # when_ready() that comes after it answers at once
+            if not store.set_file_variants(fid, variants or {}):
+                # Expired while rendering; like an upload racing BlobStore.reclaim
+                # this can orphan the variant blobs, never dangle a record
+                variants = None
+            callbacks = self.waiters.pop(fid, [])
+        for callback in callbacks:
+            try:
+                callback(variants)
+            except Exception as e:
+                logger.error(f"Image callback error for {fid}: {e}")
+    
+    def work(self):
+        while True:
+            fid = self.queue.get()
+            started = time.monotonic()
+            variants = None
+            try:
+                variants = self.render(fid)
+            except Exception as e:
+                logger.error(f"Image render error for {fid}: {e}")
+            finally:
+                with self.lock:
+                    self.processed += 1
+                    self.failed += 0 if variants else 1
+                    self.run_total += time.monotonic() - started
+                self.finish(fid, variants)
+                self.queue.task_done()
+    
+    def render(self, fid):
+        record = store.get_file(fid)
+        if not record or not record.get('blob'):
+            return None
+        with Image.open(blobs.path(record['blob'])) as image:
+            # JPEGs decode straight at a reduced scale, skipping most of the pixels
+            image.draft('RGB', (IMAGE_DISPLAY_MAX, IMAGE_DISPLAY_MAX))
+            alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+            image = ImageOps.exif_transpose(image).convert('RGBA' if alpha else 'RGB')
+        
+        variants = {}
+        for name, limit in self.SIZES:
+            # Each size shrinks the previous one in place
+            image.thumbnail((limit, limit), Image.LANCZOS)
+            variants[name] = self.encode(image, alpha)
+        with self.lock:
+            self.bytes_in += record['size']
+            self.bytes_out += sum(variant['size'] for variant in variants.values())
+        return variants
+    
+    def encode(self, image, alpha):
+        # Nothing from image.info is passed on, so EXIF (GPS, camera) is dropped
+        out = io.BytesIO()
+        if alpha:
+            image.save(out, 'PNG', optimize=True)
+            mime_type = 'image/png'
+        else:
+            image.save(out, 'JPEG', quality=IMAGE_QUALITY, optimize=True, progressive=True)
+            mime_type = 'image/jpeg'
+        data = out.getvalue()
+        return {
+            'blob': blobs.put(data),
+            'size': len(data),
+            'mime': mime_type,
+            'width': image.width,
+            'height': image.height
+        }
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'enabled': Image is not None,
+                'queue_depth': self.queue.qsize(),
+                'queue_capacity': self.queue.maxsize,
+                'submitted': self.submitted,
+                'processed': self.processed,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'avg_render_ms': round(self.run_total / (self.processed or 1) * 1000, 1)
+            }
+
+images = ImagePipeline(IMAGE_WORKERS, IMAGE_QUEUE_SIZE)
+
+def register_file(fid, digest, size, mime_type, filename, sid):
+    """Register a stored blob under fid, owned by session sid; images are
+    queued for their display/thumb variants"""
+    store.put_file(fid, {
+        'sid': sid,
+        'blob': digest,
+        'size': size,
+        'mime': mime_type,
+        'name': filename,
+        'created': datetime.now().isoformat()
+    })
+    if images.accepts(mime_type):
+        images.submit(fid)
+
+# Per-session wakeups for long-polling clients
+session_events = {}
+session_events_lock = threading.Lock()
+
+def get_session_event(sid):
+    """Get (or create) the condition pollers of a session wait on"""
+    with session_events_lock:
+        cond = session_events.get(sid)
+        if cond is None:
+            cond = session_events[sid] = threading.Condition()
+        return cond
+
+def notify_session(sid):
+    """Wake every poller waiting on a session"""
+    cond = get_session_event(sid)
+    with cond:
+        cond.notify_all()
+
+def append_message(sid, msg):
+    """Append a message to a session log and wake its pollers on every node"""
+    cond = get_session_event(sid)
+    with cond:
+        count = store.append_message(sid, msg)
+        cond.notify_all()
+    bus.publish('message', sid=sid, seq=count)
+    return count
 
-# Session cleanup
-def cleanup_old_sessions():
+def acknowledge(sid, seq):
+    """Client has everything up to seq: keep only the newest MESSAGE_RETAIN
+    of those in hot storage"""
+    return store.trim_messages(sid, min(seq, store.message_count(sid) - MESSAGE_RETAIN))
+
+def read_cursor(*values):
+    """First usable seq among request values (after, legacy last_count, ...)"""
+    for value in values:
+        if value not in (None, ''):
+            try:
+                return max(int(value), 0)
+            except ValueError:
+                pass
+    return 0
+
+def read_wait(value):
+    """Long-poll seconds from a request value, capped at LONG_POLL_MAX; 0 if unusable"""
     try:
-        cutoff = datetime.now() - timedelta(hours=24)
-        to_remove = []
-        for sid, data in sessions.items():
-            started = datetime.fromisoformat(data['started'])
-            if started < cutoff:
-                to_remove.append(sid)
-        
-        for sid in to_remove:
-            if sid in sessions:
-                del sessions[sid]
-            if sid in messages:
-                del messages[sid]
-            logger.info(f"Cleaned up old session: {sid}")
-    except Exception as e:
-        logger.error(f"Cleanup error: {e}")
+        wait = float(value or 0)
+    except ValueError:
+        return 0
+    # NaN fails every comparison, so it falls through to 0 as well
+    return min(wait, LONG_POLL_MAX) if wait > 0 else 0
+
+def wait_for_messages(sid, last_count, timeout, stop=None):
+    """Block until the session log grows past last_count, the session goes away,
+    stop (a threading.Event) is set or timeout"""
+    def ready():
+        # Woken by a broadcast: copy it into the log first
+        store.deliver_broadcasts(sid)
+        return (store.message_count(sid) > last_count or not store.has_session(sid)
+                or (stop is not None and stop.is_set()))
+    
+    cond = get_session_event(sid)
+    with cond:
+        return cond.wait_for(ready, timeout)
+
+def notify_all_sessions():
+    """Wake every poller on this node (costs the number of waiting sessions)"""
+    with session_events_lock:
+        conds = list(session_events.values())
+    for cond in conds:
+        with cond:
+            cond.notify_all()
+
+def drop_session_event(sid):
+    """Release a session's condition, waking anyone still waiting on it"""
+    with session_events_lock:
+        cond = session_events.pop(sid, None)
+    if cond is not None:
+        with cond:
+            cond.notify_all()
+
+# Node-to-node events. Sessions and messages live in the shared store
+# (STORAGE_BACKEND=sqlite); the bus only carries wakeups ('message',
+# 'closed'), notification hand-offs to a session's owner ('visitor') and
+# heartbeats ('hello') that tell nodes which peers are alive.
+class MessageBus:
+    """Base pub/sub bus. Subclasses implement send(data) and, if they
+    listen, feed what arrives to receive()."""
+    
+    def __init__(self, node):
+        self.node = node
+        self.handlers = {}
+        self.last_seen = {}
+        self.lock = threading.Lock()
+        self.published = 0
+        self.received = 0
+        self.errors = 0
+    
+    def subscribe(self, kind, handler):
+        self.handlers.setdefault(kind, []).append(handler)
+    
+    def publish(self, kind, **fields):
+        """Send an event to every other node (never back to this one)"""
+        try:
+            self.send(json.dumps(dict(fields, type=kind, node=self.node)).encode())
+        except Exception as e:
+            with self.lock:
+                self.errors += 1
+            logger.warning(f"Bus publish error: {e}")
+            return
+        with self.lock:
+            self.published += 1
+    
+    def send(self, data):
+        raise NotImplementedError
+    
+    def receive(self, data):
+        try:
+            event = json.loads(data)
+            node = event['node']
+        except (ValueError, TypeError, KeyError):
+            return
+        if node == self.node:
+            return
+        with self.lock:
+            self.received += 1
+            self.last_seen[node] = time.monotonic()
+        for handler in self.handlers.get(event.get('type'), ()):
+            try:
+                handler(event)
+            except Exception as e:
+                logger.error(f"Bus handler error ({event.get('type')}): {e}")
+    
+    def alive(self, node):
+        """This node, or a peer heard from within three heartbeats"""
+        if node == self.node:
+            return True
+        with self.lock:
+            seen = self.last_seen.get(node)
+        return seen is not None and time.monotonic() - seen < 3 * BUS_HEARTBEAT
+    
+    def nodes(self):
+        with self.lock:
+            peers = list(self.last_seen)
+        return [self.node] + [node for node in peers if self.alive(node)]
+    
+    def start(self):
+        threading.Thread(target=self.heartbeat, name='bus-heartbeat', daemon=True).start()
+    
+    def heartbeat(self):
+        while True:
+            self.publish('hello')
+            time.sleep(BUS_HEARTBEAT)
+    
+    def stats(self):
+        with self.lock:
+            stats = {
+                'node': self.node,
+                'published': self.published,
+                'received': self.received,
+                'errors': self.errors
+            }
+        stats['nodes'] = self.nodes()
+        return stats
+
+class LocalBus(MessageBus):
+    """In-process bus: the single-node default. Buses sharing a hub list
+    deliver to each other, which stands in for a real network in tests."""
+    
+    def __init__(self, node, hub=None):
+        super().__init__(node)
+        self.hub = hub
+        if hub is not None:
+            hub.append(self)
+    
+    def publish(self, kind, **fields):
+        if self.hub is not None:
+            super().publish(kind, **fields)
+    
+    def send(self, data):
+        for peer in self.hub:
+            if peer is not self:
+                peer.receive(data)
+    
+    def start(self):
+        if self.hub is not None:
+            super().start()
+
+class DatagramBus(MessageBus):
+    """Fire-and-forget datagrams to every peer. A lost wakeup only delays a
+    poller until its next heartbeat/timeout, never loses a message."""
+    
+    MAX_DATAGRAM = 8192
+    
+    def __init__(self, node, sock):
+        super().__init__(node)
+        self.sock = sock
+    
+    def peers(self):
+        raise NotImplementedError
+    
+    def send(self, data):
+        for addr in self.peers():
+            try:
+                self.sock.sendto(data, addr)
+            except OSError as e:
+                self.unreachable(addr, e)
+    
+    def unreachable(self, addr, error):
+        with self.lock:
+            self.errors += 1
+    
+    def start(self):
+        threading.Thread(target=self.listen, name='bus-listener', daemon=True).start()
+        super().start()
+    
+    def listen(self):
+        while True:
+            try:
+                data, _ = self.sock.recvfrom(self.MAX_DATAGRAM)
+            except OSError as e:
+                logger.error(f"Bus receive error: {e}")
+                time.sleep(1)
+                continue
+            self.receive(data)
+
+class UnixBus(DatagramBus):
+    """Nodes on one host (e.g. several workers over one SQLite file): each
+    binds <directory>/<node>.sock and sends to every socket it finds there."""
+    
+    def __init__(self, node, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.path = os.path.join(directory, f'{node}.sock')
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(self.path)
+        super().__init__(node, sock)
+    
+    def peers(self):
+        return [path for path in glob.glob(os.path.join(self.directory, '*.sock')) if path != self.path]
+    
+    def unreachable(self, addr, error):
+        super().unreachable(addr, error)
+        if isinstance(error, (ConnectionRefusedError, FileNotFoundError)):
+            # Left behind by a node that exited
+            try:
+                os.remove(addr)
+            except OSError:
+                pass
+
+class UDPBus(DatagramBus):
+    """Nodes on several hosts: UDP datagrams to a static list of peers"""
+    
+    def __init__(self, node, bind, peers):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(bind)
+        super().__init__(node, sock)
+        self.addresses = peers
+    
+    def peers(self):
+        return self.addresses
+
+def parse_address(value):
+    host, _, port = value.rpartition(':')
+    return host or '0.0.0.0', int(port)
+
+def create_bus():
+    url = urlsplit(BUS_URL)
+    if url.scheme in ('', 'local'):
+        return LocalBus(NODE_ID)
+    if STORAGE_BACKEND == 'memory':
+        logger.warning("BUS_URL set with in-memory storage: other nodes cannot see this node's sessions")
+    logger.info(f"Bus: {BUS_URL} as node {NODE_ID}")
+    if url.scheme == 'unix':
+        return UnixBus(NODE_ID, url.path)
+    if url.scheme == 'udp':
+        return UDPBus(NODE_ID, parse_address(url.netloc), [parse_address(peer) for peer in BUS_PEERS])
+    raise ValueError(f'Unsupported BUS_URL: {BUS_URL}')
+
+bus = create_bus()
+bus.subscribe('message', lambda event: notify_session(event['sid']))
+bus.subscribe('closed', lambda event: drop_session_event(event['sid']))
+bus.subscribe('broadcast', lambda event: notify_all_sessions())
+
+def session_owner(sid, data):
+    """Node responsible for a session's admin notifications: the node that
+    created it while that node is alive, otherwise this one (which takes over)"""
+    owner = data.get('node')
+    if owner is None or bus.alive(owner):
+        return owner or NODE_ID
+    store.update_session(sid, node=NODE_ID)
+    logger.info(f"Took over session {sid} from {owner}")
+    return NODE_ID
+
+# Session expiry
+class ExpiryWheel:
+    """Hashed timer wheel: session IDs bucketed by deadline tick.
+    
+    Scheduling and popping due IDs are O(1). Entries are never moved when a
+    deadline changes; the sweeper re-checks each due ID and reschedules it.
+    The entry count is kept as it changes, so len() is O(1) as well.
+    """
+    
+    def __init__(self, granularity):
+        self.granularity = granularity
+        self.buckets = {}
+        self.size = 0
+        self.cursor = int(time.time() // granularity)
+        self.lock = threading.Lock()
+    
+    def schedule(self, sid, deadline):
+        tick = max(int(-(-deadline // self.granularity)), self.cursor)
+        with self.lock:
+            bucket = self.buckets.setdefault(tick, set())
+            if sid not in bucket:
+                bucket.add(sid)
+                self.size += 1
+    
+    def pop_due(self, now):
+        """Remove and return every ID scheduled up to now"""
+        due = []
+        with self.lock:
+            last = int(now // self.granularity)
+            for tick in range(self.cursor, last + 1):
+                due.extend(self.buckets.pop(tick, ()))
+            self.cursor = last + 1
+            self.size -= len(due)
+        return due
+    
+    def __len__(self):
+        return self.size
+
+class ExpiryEngine:
+    """Single background sweeper expiring sessions, their message logs,
+    their files and stale resumable uploads.
+    
+    Uploads and history files left by a previous process go on wheels of
+    their own, so a sweep only looks at what is due; the directories are
+    scanned once, at start().
+    """
+    
+    def __init__(self, interval):
+        self.interval = interval
+        self.wheel = ExpiryWheel(interval)
+        self.uploads = ExpiryWheel(interval)
+        self.history = ExpiryWheel(interval)
+        self.lock = threading.Lock()
+        self.sweeps = 0
+        self.sessions_expired = 0
+        self.files_reclaimed = 0
+        self.blobs_reclaimed = 0
+        self.bytes_reclaimed = 0
+        self.uploads_reclaimed = 0
+        self.history_reclaimed = 0
+        self.last_sweep_ms = 0.0
+    
+    def deadline(self, data):
+        """Epoch seconds at which a session (dict from the store) expires"""
+        deadline = epoch_time(data['started']) + SESSION_TTL
+        if SESSION_IDLE_TTL:
+            deadline = min(deadline, epoch_time(data['last_active']) + SESSION_IDLE_TTL)
+        return deadline
+    
+    def track(self, sid, data):
+        self.wheel.schedule(sid, self.deadline(data))
+    
+    def closed(self, sid):
+        """Session record removed (/close): reclaim what it left behind after a grace period"""
+        self.wheel.schedule(sid, time.time() + CLOSED_SESSION_GRACE)
+    
+    def track_upload(self, upload_id, touched=None):
+        """Reclaim a resumable upload once it goes SESSION_TTL without a chunk"""
+        self.uploads.schedule(upload_id, (touched or time.time()) + SESSION_TTL)
+    
+    def start(self):
+        # Sessions that survived a restart in a persistent store
+        for sid, data in store.list_sessions():
+            self.track(sid, data)
+        if isinstance(store, MemoryStore):
+            # Logs of sessions closed before a journaled restart
+            for sid in set(store.messages) - set(store.sessions):
+                self.closed(sid)
+            if store.cold is not None:
+                # Live logs are deleted with their session well within the
+                # TTL, so only leftovers are still there when these come due
+                for path in store.cold.paths():
+                    self.history.schedule(path, (self.last_modified([path]) or 0) + SESSION_TTL + CLOSED_SESSION_GRACE)
+        if os.path.isdir(UPLOAD_DIR):
+            for entry in os.scandir(UPLOAD_DIR):
+                upload_id, ext = os.path.splitext(entry.name)
+                if ext in ('.json', '.done'):
+                    self.track_upload(upload_id, entry.stat().st_mtime)
+        threading.Thread(target=self.run, name='expiry', daemon=True).start()
+    
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Expiry sweep error: {e}")
+    
+    def sweep(self):
+        started = time.monotonic()
+        now = time.time()
+        for sid in self.wheel.pop_due(now):
+            data = store.get_session(sid)
+            if data is not None:
+                deadline = self.deadline(data)
+                if deadline > now:
+                    self.wheel.schedule(sid, deadline)
+                    continue
+            self.expire(sid, data is not None)
+        # A session started before an announcement is gone one TTL (and a
+        # sweep) after it, so nothing can still need it
+        store.prune_broadcasts(now - SESSION_TTL - self.interval)
+        for upload_id in self.uploads.pop_due(now):
+            self.reclaim_upload(upload_id, now)
+        for path in self.history.pop_due(now):
+            self.reclaim_history(path, now)
+        with self.lock:
+            self.sweeps += 1
+            self.last_sweep_ms = round((time.monotonic() - started) * 1000, 1)
+    
+    def expire(self, sid, live=True):
+        """Drop a session and everything it owns; live=False for the leftovers of a closed one"""
+        had_messages = store.message_count(sid) > 0
+        store.delete_session(sid)
+        store.delete_messages(sid)
+        records = store.delete_session_files(sid)
+        drop_session_event(sid)
+        bus.publish('closed', sid=sid)
+        coalescer.forget(sid)
+        if not (live or had_messages or records):
+            # Already reclaimed through another wheel entry
+            return
+        
+        freed_blobs = freed_bytes = 0
+        for digest in {digest for record in records for digest in file_blobs(record)}:
+            if not store.blob_in_use(digest):
+                size = blobs.reclaim(digest)
+                if size:
+                    store.forget_blob(digest)
+                    freed_blobs += 1
+                    freed_bytes += size
+        
+        with self.lock:
+            self.sessions_expired += 1
+            self.files_reclaimed += len(records)
+            self.blobs_reclaimed += freed_blobs
+            self.bytes_reclaimed += freed_bytes
+        logger.info(f"Expired session: {sid} ({len(records)} files, {freed_bytes} bytes freed)")
+    
+    def last_modified(self, paths):
+        """Newest mtime among paths, or None when none of them exists"""
+        mtimes = []
+        for path in paths:
+            try:
+                mtimes.append(os.path.getmtime(path))
+            except FileNotFoundError:
+                pass
+        return max(mtimes, default=None)
+    
+    def reclaim_upload(self, upload_id, now):
+        """Drop a resumable upload nobody finalized within the session TTL,
+        or the .done answer of one that was"""
+        paths = upload_paths(upload_id)
+        touched = self.last_modified(paths)
+        if touched is None:
+            return
+        if now - touched <= SESSION_TTL:
+            self.track_upload(upload_id, touched)
+            return
+        finalized = os.path.exists(paths[2])
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        if not finalized:
+            with self.lock:
+                self.uploads_reclaimed += 1
+    
+    def reclaim_history(self, path, now):
+        """Drop a history file left by a previous process once it has gone
+        untouched for the longest a session can live"""
+        max_age = SESSION_TTL + CLOSED_SESSION_GRACE
+        touched = self.last_modified([path])
+        if touched is None:
+            return
+        if now - touched <= max_age:
+            self.history.schedule(path, touched + max_age)
+            return
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self.lock:
+            self.history_reclaimed += 1
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'scheduled': len(self.wheel),
+                'uploads_scheduled': len(self.uploads),
+                'sweeps': self.sweeps,
+                'sessions_expired': self.sessions_expired,
+                'files_reclaimed': self.files_reclaimed,
+                'blobs_reclaimed': self.blobs_reclaimed,
+                'bytes_reclaimed': self.bytes_reclaimed,
+                'uploads_reclaimed': self.uploads_reclaimed,
+                'history_reclaimed': self.history_reclaimed,
+                'last_sweep_ms': self.last_sweep_ms
+            }
+
+expiry = ExpiryEngine(SWEEP_INTERVAL)
+
+# Keep-alive connections to the Bot API, shared by every thread
+telegram_url = urlsplit(TELEGRAM_API)
+telegram_connections = queue.LifoQueue(maxsize=TELEGRAM_WORKERS * 2)
+
+# Errors that mean a pooled keep-alive connection went stale between calls
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.CannotSendRequest,
+    ConnectionResetError,
+    BrokenPipeError
+)
+
+def new_telegram_connection():
+    if telegram_url.scheme == 'http':
+        conn = http.client.HTTPConnection(telegram_url.netloc, timeout=TELEGRAM_TIMEOUT)
+    else:
+        conn = http.client.HTTPSConnection(telegram_url.netloc, timeout=TELEGRAM_TIMEOUT)
+    # Streamed multipart bodies go out in several writes; don't let Nagle hold the last one
+    conn.connect()
+    conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return conn
+
+def telegram_http(verb, path, make_body=lambda: None, headers=None):
+    """Send one request over a pooled connection, returning (status, body bytes).
+    
+    make_body is called per attempt so a request can be replayed once on a
+    fresh connection if the pooled one turns out to be stale.
+    """
+    for attempt in range(2):
+        try:
+            conn, reused = telegram_connections.get_nowait(), True
+        except queue.Empty:
+            conn, reused = new_telegram_connection(), False
+        
+        try:
+            conn.request(verb, path, body=make_body(), headers=headers or {})
+            response = conn.getresponse()
+            payload = response.read()
+        except STALE_CONNECTION_ERRORS:
+            conn.close()
+            if reused and attempt == 0:
+                continue
+            raise
+        except Exception:
+            conn.close()
+            raise
+        
+        if response.will_close:
+            conn.close()
+        else:
+            try:
+                telegram_connections.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+        return response.status, payload
+
+class TokenBucket:
+    """Token bucket that hands out reservations instead of blocking"""
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def reserve(self):
+        """Take a token, returning how many seconds to wait before using it"""
+        with self.lock:
+            now = time.monotonic()
+            if now > self.updated:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+            self.tokens -= 1
+            # updated is in the future while paused
+            wait = self.updated - now
+            if self.tokens < 0:
+                wait += -self.tokens / self.rate
+            return wait
+    
+    def pause(self, seconds):
+        """Hand out nothing for seconds (Telegram's retry_after), then one token"""
+        with self.lock:
+            resume = time.monotonic() + seconds
+            if resume > self.updated:
+                self.updated = resume
+                self.tokens = min(self.tokens, 1)
+
+class TelegramRateLimiter:
+    """Per-chat and global token buckets in front of every chat-bound API call"""
+    
+    def __init__(self, chat_rate, chat_burst, global_rate):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self.lock = threading.Lock()
+        self.throttled = 0
+        self.throttle_seconds = 0.0
+        self.rate_limited = 0
+    
+    def chat_bucket(self, chat_id):
+        with self.lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            return bucket
+    
+    def acquire(self, chat_id):
+        """Sleep until both the global and the chat's bucket allow a send"""
+        wait = max(self.global_bucket.reserve(), self.chat_bucket(str(chat_id)).reserve())
+        if wait > 0:
+            with self.lock:
+                self.throttled += 1
+                self.throttle_seconds += wait
+            time.sleep(wait)
+    
+    def retry_after(self, chat_id, seconds):
+        """Telegram answered 429: stop sending to that chat for seconds"""
+        with self.lock:
+            self.rate_limited += 1
+        if chat_id is None:
+            self.global_bucket.pause(seconds)
+        else:
+            self.chat_bucket(str(chat_id)).pause(seconds)
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'throttled': self.throttled,
+                'throttle_seconds': round(self.throttle_seconds, 1),
+                'rate_limited_429': self.rate_limited
+            }
+
+rate_limiter = TelegramRateLimiter(TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_GLOBAL_RATE)
 
 def telegram_request(method, data=None, files_data=None):
     """Make Telegram API request"""
+    started = time.monotonic()
+    status = 'error'
     try:
-        url = f'{TELEGRAM_API}/{method}'
+        path = f'{telegram_url.path}/{method}'
+        chat_id = data.get('chat_id') if data else None
         
         if files_data:
             # Multipart form data for file uploads
-            import mimetypes
             boundary = '----WebKitFormBoundary' + str(uuid.uuid4()).replace('-', '')
             body = []
             
@@ -65,7 +2560,7 @@ def telegram_request(method, data=None, files_data=None):
                     body.append(b'')
                     body.append(str(value).encode())
             
-            # Add file
+            # Add file (bytes, or an open binary file to stream from disk)
             for field_name, (filename, file_data, mime_type) in files_data.items():
                 body.append(f'--{boundary}'.encode())
                 body.append(f'Content-Disposition: form-data; name="{field_name}"; filename="{filename}"'.encode())
@@ -74,52 +2569,117 @@ def telegram_request(method, data=None, files_data=None):
                 body.append(file_data)
             
             body.append(f'--{boundary}--'.encode())
-            body = b'\r\n'.join(body)
+            headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
             
-            req = Request(url, data=body, headers={
-                'Content-Type': f'multipart/form-data; boundary={boundary}'
-            })
+            file_parts = [(part, part.tell()) for part in body if hasattr(part, 'read')]
+            if file_parts:
+                headers['Content-Length'] = str(multipart_size(body))
+                
+                def make_body():
+                    for part, position in file_parts:
+                        part.seek(position)
+                    return iter_multipart(body)
+            else:
+                joined = b'\r\n'.join(body)
+                make_body = lambda: joined
+            verb = 'POST'
         elif data:
             data_encoded = json.dumps(data).encode('utf-8')
-            req = Request(url, data=data_encoded, headers={'Content-Type': 'application/json'})
+            verb, make_body, headers = 'POST', lambda: data_encoded, {'Content-Type': 'application/json'}
         else:
-            req = Request(url)
+            verb, make_body, headers = 'GET', lambda: None, {}
+        
+        for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+            if chat_id is not None:
+                rate_limiter.acquire(chat_id)
+            status, payload = telegram_http(verb, path, make_body, headers)
+            result = json.loads(payload.decode('utf-8'))
+            
+            if status != 429 or attempt == TELEGRAM_MAX_RETRIES:
+                break
+            retry_after = result.get('parameters', {}).get('retry_after', 1)
+            logger.warning(f"Telegram {method} rate limited, retrying after {retry_after}s")
+            rate_limiter.retry_after(chat_id, retry_after)
+            if chat_id is None:
+                time.sleep(retry_after)
         
-        with urlopen(req, timeout=30) as response:
-            result = json.loads(response.read().decode('utf-8'))
-            return result
+        if status >= 400:
+            logger.error(f"Telegram {method} error: HTTP {status} {result.get('description', '')}")
+            return None
+        return result
     except Exception as e:
         logger.error(f"Telegram {method} error: {e}")
         return None
+    finally:
+        metrics.observe('livechat_telegram_request_duration_seconds', (('method', method),), time.monotonic() - started)
+        metrics.inc('livechat_telegram_requests_total', (('method', method), ('status', str(status))))
+
+def multipart_size(parts):
+    """Length of CRLF-joined parts, where file parts are sized via fstat"""
+    size = 2 * (len(parts) - 1)
+    for part in parts:
+        if hasattr(part, 'read'):
+            size += os.fstat(part.fileno()).st_size - part.tell()
+        else:
+            size += len(part)
+    return size
 
-def send_message(chat_id, text):
+def iter_multipart(parts):
+    """Yield CRLF-joined parts, reading file parts in chunks"""
+    for i, part in enumerate(parts):
+        if i:
+            yield b'\r\n'
+        if hasattr(part, 'read'):
+            yield from iter(lambda: part.read(64 * 1024), b'')
+        else:
+            yield part
+
+def send_message(chat_id, text, reply_markup=None):
     """Send text message"""
-    return telegram_request('sendMessage', {
+    data = {
         'chat_id': chat_id,
         'text': text,
         'parse_mode': 'HTML'
-    })
+    }
+    if reply_markup:
+        data['reply_markup'] = reply_markup
+    return telegram_request('sendMessage', data)
+
+def edit_message(chat_id, message_id, text, reply_markup=None):
+    """Replace the text of a message the bot sent"""
+    data = {
+        'chat_id': chat_id,
+        'message_id': message_id,
+        'text': text,
+        'parse_mode': 'HTML'
+    }
+    if reply_markup:
+        data['reply_markup'] = reply_markup
+    return telegram_request('editMessageText', data)
+
+def answer_callback(callback_id, text=''):
+    """Acknowledge an inline keyboard press (stops the button spinner)"""
+    return telegram_request('answerCallbackQuery', {'callback_query_id': callback_id, 'text': text})
+
+def send_media(method, field, chat_id, source, filename, mime_type, caption):
+    """Send a file: bytes or an open file are uploaded, a str is a
+    file_id Telegram already has and goes out without an upload"""
+    data = {'chat_id': chat_id, 'caption': caption, 'parse_mode': 'HTML'}
+    if isinstance(source, str):
+        return telegram_request(method, dict(data, **{field: source}))
+    return telegram_request(method, data=data, files_data={field: (filename, source, mime_type)})
 
 def send_photo(chat_id, photo_data, caption=''):
     """Send photo to Telegram"""
-    return telegram_request('sendPhoto', 
-        data={'chat_id': chat_id, 'caption': caption, 'parse_mode': 'HTML'},
-        files_data={'photo': ('photo.jpg', photo_data, 'image/jpeg')}
-    )
+    return send_media('sendPhoto', 'photo', chat_id, photo_data, 'photo.jpg', 'image/jpeg', caption)
 
 def send_document(chat_id, document_data, filename, mime_type, caption=''):
     """Send document to Telegram"""
-    return telegram_request('sendDocument',
-        data={'chat_id': chat_id, 'caption': caption, 'parse_mode': 'HTML'},
-        files_data={'document': (filename, document_data, mime_type)}
-    )
+    return send_media('sendDocument', 'document', chat_id, document_data, filename, mime_type, caption)
 
 def send_audio(chat_id, audio_data, filename, caption=''):
     """Send audio/voice to Telegram"""
-    return telegram_request('sendVoice',
-        data={'chat_id': chat_id, 'caption': caption, 'parse_mode': 'HTML'},
-        files_data={'voice': (filename, audio_data, 'audio/ogg')}
-    )
+    return send_media('sendVoice', 'voice', chat_id, audio_data, filename, 'audio/ogg', caption)
 
 def download_telegram_file(file_id):
     """Download file from Telegram"""
@@ -130,49 +2690,321 @@ def download_telegram_file(file_id):
             return None
         
         file_path = result['result']['file_path']
-        file_url = f'https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}'
         
-        # Download file
-        with urlopen(file_url, timeout=30) as response:
-            return response.read()
+        # Download file (same host, so it reuses the keep-alive pool)
+        status, payload = telegram_http('GET', f'{urlsplit(TELEGRAM_FILE_API).path}/{file_path}')
+        if status != 200:
+            logger.error(f"Download error: HTTP {status}")
+            return None
+        return payload
     except Exception as e:
         logger.error(f"Download error: {e}")
         return None
 
+
+class TelegramFileCache:
+    """Reuses files Telegram already has, in both directions.
+    
+    Inbound, a file's file_unique_id (stable across resends) maps to our
+    blob, so a price list the admin sends to ten visitors is downloaded once.
+    Outbound, the file_id Telegram returns for an upload is kept per blob
+    and kind, so the same visitor file is never uploaded twice.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.download_hits = 0
+        self.download_misses = 0
+        self.upload_hits = 0
+        self.upload_misses = 0
+        self.bytes_saved = 0
+    
+    def fetch(self, file, kind):
+        """Store a Telegram file object (photo size, document, voice, audio)
+        in the blob store, returning (digest, size), or None if the download fails"""
+        unique_id = file.get('file_unique_id')
+        cached = store.get_telegram_blob(unique_id) if unique_id else None
+        if cached:
+            # Touched first so expiry cannot reclaim it before it is registered
+            blobs.touch(blobs.path(cached[0]))
+            if blobs.exists(cached[0]):
+                with self.lock:
+                    self.download_hits += 1
+                    self.bytes_saved += cached[1]
+                return cached
+        
+        data = download_telegram_file(file['file_id'])
+        if not data:
+            return None
+        digest = blobs.put(data)
+        if unique_id:
+            store.put_telegram_blob(unique_id, digest, len(data))
+        store.put_telegram_file_id(digest, kind, file['file_id'])
+        with self.lock:
+            self.download_misses += 1
+        return digest, len(data)
+    
+    def send(self, kind, digest, send):
+        """Call send(source) with Telegram's file_id for the blob when known,
+        else with the open blob file, remembering the file_id that comes back"""
+        file_id = store.get_telegram_file_id(digest, kind)
+        if file_id:
+            result = send(file_id)
+            if result:
+                with self.lock:
+                    self.upload_hits += 1
+                    self.bytes_saved += os.path.getsize(blobs.path(digest))
+                return result
+            # Rejected (e.g. the bot token changed): upload after all
+        
+        with open(blobs.path(digest), 'rb') as file_obj:
+            result = send(file_obj)
+        with self.lock:
+            self.upload_misses += 1
+        sent = result.get('result', {}).get(kind) if result else None
+        if sent:
+            # Photos come back as a list of sizes, largest last
+            store.put_telegram_file_id(digest, kind, (sent[-1] if kind == 'photo' else sent)['file_id'])
+        return result
+    
+    def stats(self):
+        with self.lock:
+            downloads = self.download_hits + self.download_misses
+            uploads = self.upload_hits + self.upload_misses
+            return {
+                'download_hits': self.download_hits,
+                'download_misses': self.download_misses,
+                'download_hit_rate': round(self.download_hits / (downloads or 1), 3),
+                'upload_hits': self.upload_hits,
+                'upload_misses': self.upload_misses,
+                'upload_hit_rate': round(self.upload_hits / (uploads or 1), 3),
+                'bytes_saved': self.bytes_saved
+            }
+
+telegram_files = TelegramFileCache()
+
+# Dispatch priorities: visitor notifications jump ahead of admin chatter
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+class TelegramDispatcher:
+    """Fixed pool of worker threads draining a bounded priority queue of
+    outbound Telegram calls, so a burst of visitors never spawns a thread per call."""
+    
+    def __init__(self, workers, maxsize):
+        self.queue = queue.PriorityQueue(maxsize=maxsize)
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.in_flight = 0
+        self.wait_total = 0.0
+        self.run_total = 0.0
+        self.run_max = 0.0
+        for i in range(workers):
+            threading.Thread(target=self.work, name=f'telegram-{i}', daemon=True).start()
+    
+    def submit(self, fn, *args, priority=PRIORITY_NORMAL):
+        """Queue fn(*args); returns False (and drops it) when the queue is full"""
+        try:
+            # The sequence number keeps FIFO order within a priority
+            self.queue.put_nowait((priority, next(self.sequence), time.monotonic(), fn, args))
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            logger.warning(f"Telegram queue full, dropped {getattr(fn, '__name__', fn)}")
+            return False
+        with self.lock:
+            self.submitted += 1
+        return True
+    
+    def work(self):
+        while True:
+            _, _, queued_at, fn, args = self.queue.get()
+            started = time.monotonic()
+            with self.lock:
+                self.in_flight += 1
+            ok = True
+            try:
+                fn(*args)
+            except Exception as e:
+                ok = False
+                logger.error(f"Telegram job {getattr(fn, '__name__', fn)} error: {e}")
+            finally:
+                elapsed = time.monotonic() - started
+                with self.lock:
+                    self.in_flight -= 1
+                    self.completed += 1
+                    self.failed += 0 if ok else 1
+                    self.wait_total += started - queued_at
+                    self.run_total += elapsed
+                    self.run_max = max(self.run_max, elapsed)
+                self.queue.task_done()
+    
+    def stats(self):
+        with self.lock:
+            done = self.completed or 1
+            return {
+                'queue_depth': self.queue.qsize(),
+                'queue_capacity': self.queue.maxsize,
+                'in_flight': self.in_flight,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'avg_wait_ms': round(self.wait_total / done * 1000, 1),
+                'avg_latency_ms': round(self.run_total / done * 1000, 1),
+                'max_latency_ms': round(self.run_max * 1000, 1)
+            }
+
+dispatcher = TelegramDispatcher(TELEGRAM_WORKERS, TELEGRAM_QUEUE_SIZE)
+
+def notify_admin(text, priority=PRIORITY_NORMAL, reply_markup=None):
+    """Queue a text message to the admin chat"""
+    return dispatcher.submit(send_message, ADMIN_ID, text, reply_markup, priority=priority)
+
+class NotificationCoalescer:
+    """Folds a session's consecutive visitor messages into one admin
+    notification that is edited in place while they keep typing.
+    
+    A burst ends when the window passes without a new message or anything
+    else (admin reply, file, broadcast) lands in the session log.
+    """
+    
+    MAX_TEXT = 3500  # Telegram caps messages at 4096 characters
+    
+    def __init__(self, window):
+        self.window = window
+        self.lock = threading.Lock()
+        self.bursts = {}
+    
+    def add(self, sid, count, user, page_url, page_title, msg):
+        """Record a visitor message that made the session log count long"""
+        now = time.monotonic()
+        with self.lock:
+            burst = self.bursts.get(sid)
+            if (burst is None or burst['count'] != count - 1 or now - burst['last'] > self.window
+                    or burst['length'] + len(msg) > self.MAX_TEXT):
+                burst = self.bursts[sid] = {
+                    'lines': [], 'length': 0, 'message_id': None,
+                    'busy': False, 'dirty': False
+                }
+            burst.update(count=count, last=now, user=user, page_url=page_url, page_title=page_title)
+            burst['lines'].append(msg)
+            burst['length'] += len(msg)
+            
+            if burst['busy']:
+                # The queued/running flush will pick this line up
+                burst['dirty'] = True
+                return
+            burst['busy'] = True
+        if not dispatcher.submit(self.flush, sid, burst, priority=PRIORITY_HIGH):
+            # Dropped on a full queue: the next line in the burst tries again
+            # (and its notification carries this one too)
+            with self.lock:
+                burst['busy'] = burst['dirty'] = False
+    
+    def render(self, sid, burst):
+        user = burst['user']
+        lines = burst['lines']
+        if len(lines) == 1:
+            body = f"💭 <b>Message:</b> {lines[0]}"
+        else:
+            body = f"💭 <b>Messages ({len(lines)}):</b>\n" + "\n".join(f"• {line}" for line in lines)
+        return (
+            f"💬 <b>নতুন মেসেজ</b>\n\n"
+            f"👤 <b>User:</b> {user['name']}\n"
+            f"📧 <b>Email:</b> {user.get('email', 'N/A')}\n"
+            f"📄 <b>Current Page:</b> {burst['page_title']}\n"
+            f"🔗 <b>URL:</b> {burst['page_url']}\n\n"
+            f"{body}\n\n"
+            f"📋 <b>Session:</b> <code>{sid}</code>\n\n"
+            f"📝 Reply: <code>{sid}: Your message</code>"
+        )
+    
+    def flush(self, sid, burst):
+        """Send (or edit) the burst's notification until no new lines are pending"""
+        while True:
+            with self.lock:
+                text = self.render(sid, burst)
+                message_id = burst['message_id']
+                burst['dirty'] = False
+            
+            result = None
+            if message_id is not None:
+                result = edit_message(ADMIN_ID, message_id, text)
+            if not result or not result.get('ok'):
+                # First send, or the edit failed (message deleted, too old...)
+                result = send_message(ADMIN_ID, text)
+                if result and result.get('ok'):
+                    with self.lock:
+                        burst['message_id'] = result['result']['message_id']
+            
+            with self.lock:
+                if not burst['dirty']:
+                    burst['busy'] = False
+                    return
+    
+    def forget(self, sid):
+        with self.lock:
+            self.bursts.pop(sid, None)
+
+coalescer = NotificationCoalescer(COALESCE_WINDOW)
+
 # Routes
+@app.before_request
+def start_request_timer():
+    g.started = time.monotonic()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('started')
+    if started is not None:
+        # The rule template, not the path, so session IDs never become labels
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('livechat_http_request_duration_seconds', (('route', route),), time.monotonic() - started)
+        metrics.inc('livechat_http_requests_total', (
+            ('route', route), ('method', request.method), ('status', str(response.status_code))
+        ))
+    return response
+
 @app.route('/api/chat/init', methods=['POST'])
 def init_chat():
     data = request.json
-    sid = f"SES_{datetime.now().strftime('%Y%m%d%H%M%S%f')[:17]}"
+    sid = sid_generator.next()
     
-    sessions[sid] = {
+    now = time.time()
+    session_data = {
         'name': data.get('name', 'Anonymous'),
         'email': data.get('email', ''),
-        'started': datetime.now().isoformat(),
-        'last_active': datetime.now().isoformat(),
+        'started': now,
+        'last_active': now,
         'initial_page': data.get('page_url', 'Unknown'),
         'initial_page_title': data.get('page_title', 'Unknown')
     }
-    messages[sid] = []
-    
-    import threading
-    threading.Thread(target=cleanup_old_sessions, daemon=True).start()
+    if BUS_URL:
+        session_data['node'] = NODE_ID
+    store.create_session(sid, session_data)
+    expiry.track(sid, session_data)
     
     # Send notification to admin
-    page_info = sessions[sid]['initial_page_title']
-    page_url = sessions[sid]['initial_page']
+    page_info = session_data['initial_page_title']
+    page_url = session_data['initial_page']
     notification = (
         f"🆕 <b>নতুন Chat Session শুরু হয়েছে!</b>\n\n"
-        f"👤 <b>Name:</b> {sessions[sid]['name']}\n"
-        f"📧 <b>Email:</b> {sessions[sid].get('email', 'N/A')}\n"
+        f"👤 <b>Name:</b> {session_data['name']}\n"
+        f"📧 <b>Email:</b> {session_data.get('email', 'N/A')}\n"
         f"📄 <b>Page:</b> {page_info}\n"
         f"🔗 <b>URL:</b> {page_url}\n\n"
         f"📋 <b>Session ID:</b> <code>{sid}</code>\n"
         f"⏰ <b>Time:</b> {datetime.now().strftime('%I:%M %p')}"
     )
-    threading.Thread(target=send_message, args=(ADMIN_ID, notification), daemon=True).start()
+    notify_admin(notification, PRIORITY_HIGH)
     
-    logger.info(f"New session: {sid} - {sessions[sid]['name']} from {page_info}")
+    logger.info(f"New session: {sid} - {session_data['name']} from {page_info}")
     
     return jsonify({
         'success': True,
@@ -180,6 +3012,53 @@ def init_chat():
         'message': 'Session created'
     })
 
+def record_visitor_message(sid, msg, page_url, page_title):
+    """Store a visitor text message and notify the admin"""
+    count = append_message(sid, {
+        'from': 'visitor',
+        'message': msg,
+        'type': 'text',
+        'timestamp': time.time(),
+        'page_url': page_url,
+        'page_title': page_title
+    })
+    
+    user = store.get_session(sid) or {'name': 'Unknown'}
+    if COALESCE_WINDOW > 0:
+        owner = session_owner(sid, user)
+        if owner != NODE_ID:
+            # Bursts are folded where the rest of the session's burst lives
+            bus.publish('visitor', sid=sid, seq=count, to=owner)
+            return
+        coalescer.add(sid, count, user, page_url, page_title, msg)
+        return
+    
+    text = (
+        f"💬 <b>নতুন মেসেজ</b>\n\n"
+        f"👤 <b>User:</b> {user['name']}\n"
+        f"📧 <b>Email:</b> {user.get('email', 'N/A')}\n"
+        f"📄 <b>Current Page:</b> {page_title}\n"
+        f"🔗 <b>URL:</b> {page_url}\n\n"
+        f"💭 <b>Message:</b> {msg}\n\n"
+        f"📋 <b>Session:</b> <code>{sid}</code>\n\n"
+        f"📝 Reply: <code>{sid}: Your message</code>"
+    )
+    
+    notify_admin(text, PRIORITY_HIGH)
+
+def coalesce_remote_message(event):
+    """A visitor message stored by another node, for a session this node owns"""
+    if event.get('to') != NODE_ID:
+        return
+    sid, seq = event['sid'], event['seq']
+    msgs = store.get_messages(sid, seq - 1, seq)
+    if msgs:
+        msg = msgs[0]
+        user = store.get_session(sid) or {'name': 'Unknown'}
+        coalescer.add(sid, seq, user, msg.get('page_url', 'Unknown'), msg.get('page_title', 'Unknown'), msg['message'])
+
+bus.subscribe('visitor', coalesce_remote_message)
+
 @app.route('/api/chat/send', methods=['POST'])
 def send_msg():
     try:
@@ -189,38 +3068,101 @@ def send_msg():
         page_url = data.get('page_url', 'Unknown')
         page_title = data.get('page_title', 'Unknown')
         
-        if not sid or sid not in sessions:
+        if not sid or not store.has_session(sid):
             return jsonify({'success': False, 'error': 'Invalid session'}), 400
         
-        messages[sid].append({
-            'from': 'visitor',
-            'message': msg,
-            'type': 'text',
-            'timestamp': datetime.now().isoformat(),
-            'page_url': page_url,
-            'page_title': page_title
-        })
-        
-        user = sessions[sid]
-        text = (
-            f"💬 <b>নতুন মেসেজ</b>\n\n"
-            f"👤 <b>User:</b> {user['name']}\n"
-            f"📧 <b>Email:</b> {user.get('email', 'N/A')}\n"
-            f"📄 <b>Current Page:</b> {page_title}\n"
-            f"🔗 <b>URL:</b> {page_url}\n\n"
-            f"💭 <b>Message:</b> {msg}\n\n"
-            f"📋 <b>Session:</b> <code>{sid}</code>\n\n"
-            f"📝 Reply: <code>{sid}: Your message</code>"
-        )
-        
-        from threading import Thread
-        Thread(target=send_message, args=(ADMIN_ID, text), daemon=True).start()
+        record_visitor_message(sid, msg, page_url, page_title)
         
         return jsonify({'success': True})
     except Exception as e:
         logger.error(f"Send error: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def record_visitor_file(sid, fid, filename, mime_type, msg, page_url, page_title):
+    """Store a visitor file message and forward the file to the admin"""
+    record = store.get_file(fid)
+    digest = record['blob']
+    
+    # Detect if it's voice message
+    is_voice = 'voice-message' in filename.lower() or mime_type.startswith('audio/')
+    
+    if is_voice:
+        msg_type = 'voice'
+    elif mime_type.startswith('image/'):
+        msg_type = 'image'
+    else:
+        msg_type = 'file'
+    
+    append_message(sid, {
+        'from': 'visitor',
+        'message': msg,
+        'type': msg_type,
+        'file_id': fid,
+        'filename': filename,
+        'timestamp': time.time(),
+        'page_url': page_url,
+        'page_title': page_title
+    })
+    
+    # Send to admin with actual file
+    user = store.get_session(sid) or {'name': 'Unknown'}
+    caption = (
+        f"💬 <b>নতুন মেসেজ</b>\n\n"
+        f"👤 {user['name']}\n"
+        f"📧 {user.get('email', 'N/A')}\n"
+        f"📄 <b>Page:</b> {page_title}\n"
+        f"🔗 {page_url}\n\n"
+        f"💭 {msg if msg else '(No message)'}\n\n"
+        f"📋 <code>{sid}</code>\n\n"
+        f"Reply: <code>{sid}: Your message</code>"
+    )
+    
+    def send_file_to_admin():
+        try:
+            # Streamed from the blob file, never held in memory whole, and
+            # not at all when Telegram already has this blob
+            if is_voice:
+                # Convert webm to ogg if needed
+                telegram_files.send('voice', digest, lambda source: send_audio(ADMIN_ID, source, filename, caption))
+            elif msg_type == 'image':
+                telegram_files.send('photo', digest, lambda source: send_photo(ADMIN_ID, source, caption))
+            else:
+                telegram_files.send('document', digest,
+                                    lambda source: send_document(ADMIN_ID, source, filename, mime_type, caption))
+        except Exception as e:
+            logger.error(f"Send file to admin error: {e}")
+            # Fallback to text notification
+            send_message(ADMIN_ID, caption + f"\n\n⚠️ File: {filename}")
+    
+    def send_display_to_admin(display):
+        note = f"\n\n⚠️ Original too large for Telegram: {filename} ({record['size'] // 1024} KB)"
+        try:
+            telegram_files.send('photo', display['blob'], lambda source: send_photo(ADMIN_ID, source, caption + note))
+        except Exception as e:
+            logger.error(f"Send display image to admin error: {e}")
+            send_message(ADMIN_ID, caption + note)
+    
+    def forward_display(variants):
+        if variants:
+            dispatcher.submit(send_display_to_admin, variants['display'], priority=PRIORITY_HIGH)
+        else:
+            dispatcher.submit(send_message, ADMIN_ID, caption + f"\n\n⚠️ File too large for Telegram: {filename}",
+                              priority=PRIORITY_HIGH)
+    
+    # Over the Bot API limits only a downscaled copy (or a note) can go out
+    if msg_type == 'image' and record['size'] > TELEGRAM_PHOTO_LIMIT:
+        images.when_ready(fid, forward_display)
+    elif record['size'] > TELEGRAM_DOCUMENT_LIMIT:
+        forward_display(None)
+    else:
+        dispatcher.submit(send_file_to_admin, priority=PRIORITY_HIGH)
+    
+    logger.info(f"File uploaded: {sid} - {filename} ({msg_type})")
+
+@app.errorhandler(413)
+def too_large(e):
+    return jsonify({'success': False, 'error': f'File too large (max {UPLOAD_MAX_BYTES} bytes)'}), 413
+
 @app.route('/api/chat/upload', methods=['POST'])
 def upload():
     try:
@@ -229,128 +3171,324 @@ def upload():
         page_url = request.form.get('page_url', 'Unknown')
         page_title = request.form.get('page_title', 'Unknown')
         
-        if not sid or sid not in sessions:
+        if not sid or not store.has_session(sid):
             return jsonify({'success': False, 'error': 'Invalid session'}), 400
         
         if 'file' not in request.files:
             return jsonify({'success': False, 'error': 'No file'}), 400
         
+        # Werkzeug has already spooled large parts to a temp file;
+        # copy it into the blob store without reading it into memory
         file = request.files['file']
-        file_bytes = file.read()
         fid = str(uuid.uuid4())
         
         mime_type = file.content_type or 'application/octet-stream'
         filename = file.filename or 'file'
         
-        file_data = {
-            'data': base64.b64encode(file_bytes).decode(),
-            'mime': mime_type,
-            'name': filename
-        }
-        files[fid] = file_data
+        try:
+            digest, size = blobs.put_stream(file.stream, limit=UPLOAD_MAX_BYTES)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 413
+        register_file(fid, digest, size, mime_type, filename, sid)
+        
+        record_visitor_file(sid, fid, filename, mime_type, msg, page_url, page_title)
+        return jsonify({'success': True, 'file_id': fid})
+    except RequestEntityTooLarge as e:
+        return too_large(e)
+    except Exception as e:
+        logger.error(f"Upload error: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+# Resumable uploads: init -> PUT chunks at ?offset=N -> finalize.
+# State lives next to the partial file on disk, so any worker can
+# continue an upload and a restart does not lose it. A finalized upload
+# leaves a .done file with its file_id, so a retried finalize gets the
+# same answer until the expiry engine reclaims it.
+def upload_paths(upload_id):
+    base = os.path.join(UPLOAD_DIR, upload_id)
+    return base + '.json', base + '.part', base + '.done'
+
+def valid_upload_id(upload_id):
+    return bool(upload_id) and all(c in '0123456789abcdef' for c in upload_id)
+
+def load_upload(upload_id):
+    """Upload metadata plus the current offset, or None"""
+    if not valid_upload_id(upload_id):
+        return None
+    meta_path, part_path, _ = upload_paths(upload_id)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    meta['offset'] = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    return meta
+
+def lock_upload(upload_id):
+    """Open the upload's metadata file with an exclusive flock held (released
+    when it is closed); chunk writes and finalize serialize on it. Raises
+    FileNotFoundError once the upload is finalized or reclaimed."""
+    path = upload_paths(upload_id)[0]
+    f = open(path, 'rb')
+    fcntl.flock(f, fcntl.LOCK_EX)
+    if not os.path.exists(path):
+        # Finalized while this one waited for the lock
+        f.close()
+        raise FileNotFoundError(path)
+    return f
+
+def finalized_upload(upload_id):
+    """file_id a finalized upload became, or None"""
+    if not valid_upload_id(upload_id):
+        return None
+    try:
+        with open(upload_paths(upload_id)[2]) as f:
+            return json.load(f)['file_id']
+    except FileNotFoundError:
+        return None
+
+@app.route('/api/chat/upload/init', methods=['POST'])
+def upload_init():
+    try:
+        data = request.json
+        sid = data.get('session_id')
+        size = int(data.get('size', 0))
         
-        # Detect if it's voice message
-        is_voice = 'voice-message' in filename.lower() or mime_type.startswith('audio/')
+        if not sid or not store.has_session(sid):
+            return jsonify({'success': False, 'error': 'Invalid session'}), 400
         
-        if is_voice:
-            msg_type = 'voice'
-        elif mime_type.startswith('image/'):
-            msg_type = 'image'
-        else:
-            msg_type = 'file'
+        if size <= 0:
+            return jsonify({'success': False, 'error': 'Invalid size'}), 400
         
-        messages[sid].append({
-            'from': 'visitor',
-            'message': msg,
-            'type': msg_type,
-            'file_id': fid,
-            'filename': filename,
-            'timestamp': datetime.now().isoformat(),
-            'page_url': page_url,
-            'page_title': page_title
-        })
+        if size > UPLOAD_MAX_BYTES:
+            return jsonify({'success': False, 'error': f'File too large (max {UPLOAD_MAX_BYTES} bytes)'}), 413
         
-        # Send to admin with actual file
-        user = sessions[sid]
-        caption = (
-            f"💬 <b>নতুন মেসেজ</b>\n\n"
-            f"👤 {user['name']}\n"
-            f"📧 {user.get('email', 'N/A')}\n"
-            f"📄 <b>Page:</b> {page_title}\n"
-            f"🔗 {page_url}\n\n"
-            f"💭 {msg if msg else '(No message)'}\n\n"
-            f"📋 <code>{sid}</code>\n\n"
-            f"Reply: <code>{sid}: Your message</code>"
-        )
+        upload_id = uuid.uuid4().hex
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+        meta_path, part_path, _ = upload_paths(upload_id)
+        open(part_path, 'wb').close()
+        with open(meta_path, 'w') as f:
+            json.dump({
+                'session_id': sid,
+                'filename': data.get('filename') or 'file',
+                'mime': data.get('mime_type') or 'application/octet-stream',
+                'size': size,
+                'created': datetime.now().isoformat()
+            }, f)
+        expiry.track_upload(upload_id)
         
-        def send_file_to_admin():
-            try:
-                if is_voice:
-                    # Convert webm to ogg if needed
-                    send_audio(ADMIN_ID, file_bytes, filename, caption)
-                elif mime_type.startswith('image/'):
-                    send_photo(ADMIN_ID, file_bytes, caption)
-                else:
-                    send_document(ADMIN_ID, file_bytes, filename, mime_type, caption)
-            except Exception as e:
-                logger.error(f"Send file to admin error: {e}")
-                # Fallback to text notification
-                send_message(ADMIN_ID, caption + f"\n\n⚠️ File: {filename}")
+        return jsonify({'success': True, 'upload_id': upload_id, 'offset': 0, 'chunk_size': UPLOAD_CHUNK_SIZE})
+    except Exception as e:
+        logger.error(f"Upload init error: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/chat/upload/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    meta = load_upload(upload_id)
+    if not meta:
+        return jsonify({'success': False, 'error': 'Upload not found'}), 404
+    return jsonify({'success': True, 'upload_id': upload_id, 'offset': meta['offset'], 'size': meta['size']})
+
+@app.route('/api/chat/upload/<upload_id>', methods=['PUT', 'PATCH'])
+def upload_chunk(upload_id):
+    try:
+        meta = load_upload(upload_id)
+        if not meta:
+            return jsonify({'success': False, 'error': 'Upload not found'}), 404
+        
+        try:
+            offset = int(request.args.get('offset', request.headers.get('Upload-Offset', -1)))
+        except ValueError:
+            return jsonify({'success': False, 'error': 'Invalid offset', 'offset': meta['offset']}), 400
+        
+        _, part_path, _ = upload_paths(upload_id)
+        written = 0
+        try:
+            lock = lock_upload(upload_id)
+        except FileNotFoundError:
+            return jsonify({'success': False, 'error': 'Upload not found'}), 404
+        # A retried chunk can arrive while the first attempt is still
+        # streaming: check the offset and append under one lock, so the
+        # second PUT waits and then gets a 409 with the new offset
+        with lock, open(part_path, 'ab') as f:
+            current = os.fstat(f.fileno()).st_size
+            if offset != current:
+                # Client lost track (e.g. a chunk whose response never arrived)
+                return jsonify({'success': False, 'error': 'Offset mismatch', 'offset': current}), 409
+            
+            remaining = meta['size'] - offset
+            length = request.content_length
+            if length is not None and length > remaining:
+                return jsonify({'success': False, 'error': 'Chunk exceeds declared size', 'offset': offset}), 413
+            
+            while True:
+                chunk = request.stream.read(64 * 1024)
+                if not chunk:
+                    break
+                written += len(chunk)
+                if written > remaining:
+                    f.truncate(offset)
+                    return jsonify({'success': False, 'error': 'Chunk exceeds declared size', 'offset': offset}), 413
+                f.write(chunk)
         
-        from threading import Thread
-        Thread(target=send_file_to_admin, daemon=True).start()
+        return jsonify({'success': True, 'upload_id': upload_id, 'offset': offset + written, 'size': meta['size']})
+    except Exception as e:
+        logger.error(f"Upload chunk error: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/chat/upload/<upload_id>/finalize', methods=['POST'])
+def upload_finalize(upload_id):
+    try:
+        data = request.json or {}
+        try:
+            lock = lock_upload(upload_id) if valid_upload_id(upload_id) else None
+        except FileNotFoundError:
+            lock = None
+        if lock is None:
+            # Finalized already: a retry whose first response was lost
+            fid = finalized_upload(upload_id)
+            if fid:
+                return jsonify({'success': True, 'file_id': fid})
+            return jsonify({'success': False, 'error': 'Upload not found'}), 404
         
-        logger.info(f"File uploaded: {sid} - {filename} ({msg_type})")
+        with lock:
+            # A concurrent finalize may have finished while this one waited
+            fid = finalized_upload(upload_id)
+            if fid:
+                return jsonify({'success': True, 'file_id': fid})
+            meta = load_upload(upload_id)
+            if not meta:
+                return jsonify({'success': False, 'error': 'Upload not found'}), 404
+            
+            sid = meta['session_id']
+            if not store.has_session(sid):
+                return jsonify({'success': False, 'error': 'Invalid session'}), 400
+            
+            if meta['offset'] != meta['size']:
+                return jsonify({'success': False, 'error': 'Upload incomplete', 'offset': meta['offset']}), 409
+            
+            meta_path, part_path, done_path = upload_paths(upload_id)
+            digest, size = blobs.put_path(part_path)
+            fid = str(uuid.uuid4())
+            register_file(fid, digest, size, meta['mime'], meta['filename'], sid)
+            record_visitor_file(
+                sid, fid, meta['filename'], meta['mime'],
+                data.get('message', ''),
+                data.get('page_url', 'Unknown'),
+                data.get('page_title', 'Unknown')
+            )
+            # .done before the metadata goes, so a finalize that finds no
+            # metadata always finds the answer
+            with open(done_path, 'w') as f:
+                json.dump({'file_id': fid}, f)
+            os.remove(meta_path)
         return jsonify({'success': True, 'file_id': fid})
     except Exception as e:
-        logger.error(f"Upload error: {e}")
+        logger.error(f"Upload finalize error: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/chat/file/<fid>', methods=['GET'])
 def get_file(fid):
-    if fid not in files:
+    file_data = store.get_file(fid)
+    if not file_data:
         return jsonify({'error': 'Not found'}), 404
     
-    file_data = files[fid]
-    file_bytes = base64.b64decode(file_data['data'])
+    if 'blob' not in file_data:
+        # Record written before the blob store existed
+        return send_file(
+            io.BytesIO(base64.b64decode(file_data['data'])),
+            mimetype=file_data['mime'],
+            as_attachment=True,
+            download_name=file_data['name']
+        )
+    
+    # ?variant=display|thumb serves the downscaled copy once the image
+    # pipeline has rendered it, and the original until then
+    name = request.args.get('variant', 'original')
+    if name not in ('original',) + tuple(size for size, _ in ImagePipeline.SIZES):
+        return jsonify({'error': f'Unknown variant: {name}'}), 400
+    variant = file_data.get('variants', {}).get(name)
+    if variant:
+        base = os.path.splitext(file_data['name'])[0]
+        ext = '.png' if variant['mime'] == 'image/png' else '.jpg'
+        file_data = dict(variant, name=f'{base}_{name}{ext}', created=file_data['created'])
+    
+    if not blobs.exists(file_data['blob']):
+        return jsonify({'error': 'Not found'}), 404
     
+    # Blobs are immutable: the digest is a strong ETag, and send_file
+    # handles If-None-Match / If-Modified-Since / Range and hands the open
+    # file to the server's wsgi.file_wrapper (sendfile where supported)
     return send_file(
-        io.BytesIO(file_bytes),
+        blobs.path(file_data['blob']),
         mimetype=file_data['mime'],
-        as_attachment=True,
-        download_name=file_data['name']
+        as_attachment=not variant,
+        download_name=file_data['name'],
+        etag=file_data['blob'],
+        last_modified=datetime.fromisoformat(file_data['created']),
+        max_age=86400,
+        conditional=True
     )
 
 
+def messages_response(fields, fragments):
+    """jsonify(dict(fields, messages=[...])) built from cached message
+    fragments instead of re-encoding every message"""
+    body = '{"messages":[' + ','.join(fragment for _, fragment in fragments) + '],' + encode_json(fields)[1:]
+    return app.response_class(body, mimetype='application/json')
+
+# Conditional GET: poll/verify responses are tagged with the session's
+# message count, which only moves when its log does
+def not_modified(version):
+    """Empty 304 if the client already holds this version, else None"""
+    if request.if_none_match.contains_weak(version):
+        response = app.response_class(status=304)
+        response.set_etag(version)
+        return response
+    return None
+
+def with_version(response, version):
+    response.set_etag(version)
+    # Browsers revalidate instead of reusing the body blindly
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 @app.route('/api/chat/verify/<session_id>', methods=['GET'])
 def verify_session(session_id):
     """Verify if a session exists and is still valid"""
     try:
-        if session_id not in sessions:
+        session_data = store.get_session(session_id)
+        if not session_data:
             return jsonify({'success': False, 'error': 'Session not found'}), 404
         
-        # Check if session is too old (more than 24 hours)
-        session_data = sessions[session_id]
+        # Check if session is too old (SESSION_TTL, 24 hours by default)
         started = datetime.fromisoformat(session_data['started'])
         age = datetime.now() - started
         
-        if age.total_seconds() > 86400:  # 24 hours
+        if age.total_seconds() > SESSION_TTL:
             return jsonify({'success': False, 'error': 'Session expired'}), 404
         
-        return jsonify({
+        # age_hours has 0.1 h (6 minute) resolution
+        age_hours = round(age.total_seconds() / 3600, 1)
+        version = f'{store.message_count(session_id)}.{age_hours}'
+        cached = not_modified(version)
+        if cached is not None:
+            return cached
+        
+        return with_version(jsonify({
             'success': True,
             'session_id': session_id,
             'name': session_data.get('name'),
-            'age_hours': round(age.total_seconds() / 3600, 1)
-        })
+            'age_hours': age_hours
+        }), version)
     except Exception as e:
         logger.error(f"Verify error: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/chat/poll/<sid>', methods=['GET'])
 def poll(sid):
-    if sid in sessions:
-        sessions[sid]['last_active'] = datetime.now().isoformat()
+    if store.has_session(sid):
+        store.touch_session(sid)
     else:
         logger.warning(f"Poll for non-existent session: {sid}")
         return jsonify({
@@ -359,346 +3497,678 @@ def poll(sid):
             'session_id': sid
         }), 404
     
-    last_count = int(request.args.get('last_count', 0))
-    all_msgs = messages.get(sid, [])
-    new_msgs = all_msgs[last_count:]
+    # Cursor: the seq of the last message the client has (legacy name: last_count)
+    after = read_cursor(request.args.get('after'), request.args.get('last_count'))
+    acknowledge(sid, after)
+    store.deliver_broadcasts(sid)
     
-    return jsonify({
+    # Long-poll: hold the request open until something new arrives
+    wait = read_wait(request.args.get('wait'))
+    if wait > 0 and store.message_count(sid) <= after:
+        wait_for_messages(sid, after, wait)
+    
+    # The URL carries the cursor, so the log length is the whole version
+    version = str(store.message_count(sid))
+    cached = not_modified(version)
+    if cached is not None:
+        return cached
+    
+    new_msgs = store.get_fragments(sid, after)
+    last_seq = new_msgs[-1][0] if new_msgs else min(after, int(version))
+    
+    return with_version(messages_response({
         'success': True,
-        'messages': new_msgs,
-        'total_count': len(all_msgs)
-    })
+        'last_seq': last_seq,
+        'total_count': last_seq
+    }, new_msgs), version)
 
-@app.route('/api/chat/webhook', methods=['POST'])
-def webhook():
-    try:
-        update = request.json
-        logger.info(f"Webhook received: {json.dumps(update)[:200]}")
-        
-        if 'message' not in update:
-            return jsonify({'ok': True})
-        
-        msg = update['message']
-        chat_id = str(msg['chat']['id'])
-        
-        # Only process messages from admin
-        if chat_id != ADMIN_ID:
-            logger.info(f"Ignoring message from non-admin: {chat_id}")
-            return jsonify({'ok': True})
-        
-        # Handle text messages (replies)
-        if 'text' in msg:
-            text = msg['text'].strip()
-            
-            # /start command
-            if text == '/start':
-                welcome = (
-                    "✅ <b>Live Chat Bot Active!</b>\n\n"
-                    "🔹 Visitor থেকে message আসলে notification পাবেন\n"
-                    "🔹 Text reply: <code>SES_xxxxx: Your message</code>\n"
-                    "🔹 Photo/File reply: Photo/file পাঠান + caption এ <code>SES_xxxxx</code> লিখুন\n"
-                    "🔹 Voice reply: Voice message পাঠান + caption এ <code>SES_xxxxx</code>\n\n"
-                    "<b>Commands:</b>\n"
-                    "/sessions - Active sessions দেখুন\n"
-                    "/close SES_xxxxx - Session বন্ধ করুন\n"
-                    "/broadcast message - সবাইকে message পাঠান"
-                )
-                send_message(ADMIN_ID, welcome)
-                return jsonify({'ok': True})
-            
-            # /sessions command
-            if text == '/sessions':
-                if not sessions:
-                    send_message(ADMIN_ID, "📭 <b>No active sessions</b>")
-                else:
-                    msg_text = f"📊 <b>Active Sessions: {len(sessions)}</b>\n\n"
-                    for sid, data in list(sessions.items())[:10]:  # Show max 10
-                        started = datetime.fromisoformat(data['started'])
-                        duration = datetime.now() - started
-                        hours = duration.seconds // 3600
-                        minutes = (duration.seconds % 3600) // 60
-                        
-                        msg_text += (
-                            f"🆔 <code>{sid}</code>\n"
-                            f"👤 {data['name']}\n"
-                            f"⏱️ {hours}h {minutes}m\n"
-                            f"💬 {len(messages.get(sid, []))} messages\n\n"
-                        )
-                    
-                    if len(sessions) > 10:
-                        msg_text += f"\n<i>... and {len(sessions) - 10} more</i>"
-                    
-                    send_message(ADMIN_ID, msg_text)
-                return jsonify({'ok': True})
+@app.route('/api/chat/history/<sid>', methods=['GET'])
+def history(sid):
+    """One page of the conversation: the limit messages before seq before
+    (default: the newest), oldest first. A reopened widget loads the last
+    page, polls with after=last_seq and pages back with before=first_seq."""
+    if store.has_session(sid):
+        store.touch_session(sid)
+    else:
+        return jsonify({
+            'success': False,
+            'error': 'Session not found or expired',
+            'session_id': sid
+        }), 404
+    
+    store.deliver_broadcasts(sid)
+    count = store.message_count(sid)
+    limit = min(read_cursor(request.args.get('limit')) or HISTORY_PAGE_SIZE, HISTORY_PAGE_MAX)
+    # before=0 (or missing / invalid) means the newest page; seqs start at 1
+    before = read_cursor(request.args.get('before'))
+    end = min(before - 1, count) if before else count
+    start = max(end - limit, 0)
+    
+    # Messages never change once stored, so the range is the whole version
+    version = f'{start}-{end}'
+    cached = not_modified(version)
+    if cached is not None:
+        return cached
+    
+    page = store.get_fragments(sid, start, end)
+    return with_version(messages_response({
+        'success': True,
+        'first_seq': page[0][0] if page else None,
+        'last_seq': page[-1][0] if page else end,
+        'has_more': start > 0,
+        'total_count': count
+    }, page), version)
+
+@app.route('/api/chat/stream/<sid>', methods=['GET'])
+def stream(sid):
+    """Server-Sent Events stream of a session's messages.
+    
+    Event ids are message seqs, so a reconnecting EventSource resumes (and
+    acknowledges) via Last-Event-ID (or ?after=N).
+    """
+    if not store.has_session(sid):
+        logger.warning(f"Stream for non-existent session: {sid}")
+        return jsonify({
+            'success': False,
+            'error': 'Session not found or expired',
+            'session_id': sid
+        }), 404
+    
+    position = read_cursor(
+        request.headers.get('Last-Event-ID'), request.args.get('after'), request.args.get('last_count')
+    )
+    acknowledge(sid, position)
+    
+    def events(position):
+        yield 'retry: 3000\n\n'
+        while True:
+            store.deliver_broadcasts(sid)
+            new_msgs = store.get_fragments(sid, position)
+            if new_msgs:
+                for position, fragment in new_msgs:
+                    yield f"id: {position}\ndata: {fragment}\n\n"
+                continue
             
-            # /close command
-            if text.startswith('/close '):
-                sid = text.replace('/close ', '').strip()
-                
-                if sid not in sessions:
-                    send_message(ADMIN_ID, f"❌ Session not found: <code>{sid}</code>")
-                else:
-                    user_name = sessions[sid]['name']
-                    
-                    if sid in messages:
-                        messages[sid].append({
-                            'from': 'admin',
-                            'message': '⚠️ এই চ্যাট সেশন বন্ধ করা হয়েছে। নতুন চ্যাট শুরু করতে পেজ রিফ্রেশ করুন।',
-                            'type': 'text',
-                            'timestamp': datetime.now().isoformat()
-                        })
-                    
-                    del sessions[sid]
-                    send_message(ADMIN_ID, f"✅ Session closed: <code>{sid}</code>\n👤 User: {user_name}")
-                return jsonify({'ok': True})
+            if not store.has_session(sid):
+                yield 'event: closed\ndata: {}\n\n'
+                return
             
-            # /broadcast command
-            if text.startswith('/broadcast '):
-                broadcast_msg = text.replace('/broadcast ', '').strip()
-                
-                if not broadcast_msg:
-                    send_message(ADMIN_ID, "⚠️ Usage: <code>/broadcast Your message</code>")
-                    return jsonify({'ok': True})
-                
-                if not sessions:
-                    send_message(ADMIN_ID, "📭 No active sessions")
-                    return jsonify({'ok': True})
+            store.touch_session(sid)
+            if not wait_for_messages(sid, position, SSE_HEARTBEAT):
+                yield ': keep-alive\n\n'
+    
+    return Response(events(position), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@sock.route('/api/chat/ws/<sid>')
+def chat_socket(ws, sid):
+    """Two-way WebSocket for a session.
+    
+    Visitor frames are JSON objects with the same fields as /api/chat/send
+    ({"message", "page_url", "page_title"}), or {"ack": seq} to acknowledge
+    delivery. Server frames are {"type": "message", "position": seq,
+    "message": {...}} or {"type": "error"|"closed"}.
+    """
+    if not store.has_session(sid):
+        logger.warning(f"WebSocket for non-existent session: {sid}")
+        ws.send(json.dumps({'type': 'error', 'error': 'Session not found or expired', 'session_id': sid}))
+        return
+    
+    position = read_cursor(request.args.get('after'), request.args.get('last_count'))
+    acknowledge(sid, position)
+    
+    disconnected = threading.Event()
+    
+    def receive_loop():
+        try:
+            while True:
+                raw = ws.receive()
+                if raw is None:
+                    break
+                try:
+                    data = json.loads(raw)
+                except ValueError:
+                    data = {'message': raw}
+                if not isinstance(data, dict):
+                    data = {'message': str(data)}
                 
-                sent_count = 0
-                for sid in list(sessions.keys()):
-                    if sid in messages:
-                        messages[sid].append({
-                            'from': 'admin',
-                            'message': f"📢 <b>Announcement:</b> {broadcast_msg}",
-                            'type': 'text',
-                            'timestamp': datetime.now().isoformat()
-                        })
-                        sent_count += 1
+                if not store.has_session(sid):
+                    ws.send(json.dumps({'type': 'error', 'error': 'Invalid session', 'session_id': sid}))
+                    break
                 
-                send_message(ADMIN_ID, f"📢 Broadcast sent to {sent_count} session(s)")
-                return jsonify({'ok': True})
-            
-            # Reply to visitor
-            if ':' in text and 'SES_' in text:
-                parts = text.split(':', 1)
-                sid = parts[0].strip()
-                reply = parts[1].strip() if len(parts) > 1 else ''
+                if 'ack' in data and 'message' not in data:
+                    acknowledge(sid, read_cursor(data['ack']))
+                    continue
                 
-                if sid in sessions:
-                    messages[sid].append({
-                        'from': 'admin',
-                        'message': reply,
-                        'type': 'text',
-                        'timestamp': datetime.now().isoformat()
-                    })
-                    send_message(ADMIN_ID, f"✅ Reply sent to: <code>{sid}</code>")
-                    logger.info(f"Reply added to {sid}")
-                else:
-                    send_message(ADMIN_ID, f"❌ Session not found: <code>{sid}</code>")
-        
-        # Handle photo messages from admin
-        elif 'photo' in msg:
-            caption = msg.get('caption', '').strip()
-            
-            if 'SES_' not in caption:
-                send_message(ADMIN_ID, "⚠️ Caption এ session ID দিন\nExample: <code>SES_xxxxx</code>")
-                return jsonify({'ok': True})
-            
-            # Extract session ID
-            sid = caption.split(':')[0].strip() if ':' in caption else caption.split()[0].strip()
-            message_text = caption.split(':', 1)[1].strip() if ':' in caption else ''
-            
-            if sid not in sessions:
-                send_message(ADMIN_ID, f"❌ Session not found: <code>{sid}</code>")
-                return jsonify({'ok': True})
-            
-            # Download photo
-            photo = msg['photo'][-1]  # Highest resolution
-            file_id = photo['file_id']
-            photo_data = download_telegram_file(file_id)
-            
-            if not photo_data:
-                send_message(ADMIN_ID, "❌ Failed to download photo")
-                return jsonify({'ok': True})
-            
-            # Store file
-            fid = str(uuid.uuid4())
-            files[fid] = {
-                'data': base64.b64encode(photo_data).decode(),
-                'mime': 'image/jpeg',
-                'name': f'photo_{fid}.jpg'
-            }
+                record_visitor_message(
+                    sid,
+                    data.get('message', ''),
+                    data.get('page_url', 'Unknown'),
+                    data.get('page_title', 'Unknown')
+                )
+        except ConnectionClosed:
+            pass
+        except Exception as e:
+            logger.error(f"WebSocket receive error: {e}")
+        finally:
+            disconnected.set()
+            notify_session(sid)
+    
+    threading.Thread(target=receive_loop, daemon=True).start()
+    
+    try:
+        while not disconnected.is_set():
+            store.deliver_broadcasts(sid)
+            new_msgs = store.get_fragments(sid, position)
+            if new_msgs:
+                for position, fragment in new_msgs:
+                    ws.send(f'{{"type":"message","position":{position},"message":{fragment}}}')
+                continue
             
-            # Add to messages
-            messages[sid].append({
-                'from': 'admin',
-                'message': message_text,
-                'type': 'image',
-                'file_id': fid,
-                'filename': f'photo_{fid}.jpg',
-                'timestamp': datetime.now().isoformat()
-            })
+            if not store.has_session(sid):
+                ws.send(json.dumps({'type': 'closed', 'session_id': sid}))
+                break
             
-            send_message(ADMIN_ID, f"✅ Photo sent to: <code>{sid}</code>")
-            logger.info(f"Photo sent to {sid}")
+            store.touch_session(sid)
+            wait_for_messages(sid, position, LONG_POLL_MAX, stop=disconnected)
+    except ConnectionClosed:
+        pass
+
+# Webhook ingestion: the route only validates and enqueues; a worker
+# pool applies updates, so Telegram never waits on downloads or replies
+SESSION_ID_PATTERN = re.compile(r'SES_\w+')
+
+class UpdateQueue:
+    """Sharded worker pool for Telegram updates, deduplicated by update_id.
+    
+    Updates addressed to the same session (or, failing that, coming from the
+    same chat) land on the same worker, so they are applied in order.
+    """
+    
+    def __init__(self, workers, maxsize, window):
+        self.queues = [queue.Queue(maxsize=max(maxsize // workers, 1)) for _ in range(workers)]
+        self.window = window
+        self.recent = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.received = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        for i, q in enumerate(self.queues):
+            threading.Thread(target=self.work, args=(q,), name=f'webhook-{i}', daemon=True).start()
+    
+    def shard(self, update):
+        msg = update.get('message') or update.get('callback_query', {}).get('message') or {}
+        text = msg.get('text') or msg.get('caption') or ''
+        match = SESSION_ID_PATTERN.search(text)
+        key = match.group(0) if match else str(msg.get('chat', {}).get('id', ''))
+        return self.queues[hash(key) % len(self.queues)]
+    
+    def submit(self, update):
+        """Queue an update: returns 'queued', 'duplicate' or 'full'"""
+        update_id = update.get('update_id')
+        with self.lock:
+            self.received += 1
+            if update_id is not None:
+                if update_id in self.recent:
+                    self.duplicates += 1
+                    return 'duplicate'
+                self.recent[update_id] = True
+                if len(self.recent) > self.window:
+                    self.recent.popitem(last=False)
         
-        # Handle document/file messages from admin
-        elif 'document' in msg:
-            caption = msg.get('caption', '').strip()
-            
-            if 'SES_' not in caption:
-                send_message(ADMIN_ID, "⚠️ Caption এ session ID দিন\nExample: <code>SES_xxxxx</code>")
-                return jsonify({'ok': True})
-            
-            sid = caption.split(':')[0].strip() if ':' in caption else caption.split()[0].strip()
-            message_text = caption.split(':', 1)[1].strip() if ':' in caption else ''
-            
-            if sid not in sessions:
-                send_message(ADMIN_ID, f"❌ Session not found: <code>{sid}</code>")
-                return jsonify({'ok': True})
-            
-            # Download document
-            document = msg['document']
-            file_id = document['file_id']
-            file_data = download_telegram_file(file_id)
-            
-            if not file_data:
-                send_message(ADMIN_ID, "❌ Failed to download file")
-                return jsonify({'ok': True})
-            
-            # Store file
-            fid = str(uuid.uuid4())
-            filename = document.get('file_name', f'file_{fid}')
-            mime_type = document.get('mime_type', 'application/octet-stream')
-            
-            files[fid] = {
-                'data': base64.b64encode(file_data).decode(),
-                'mime': mime_type,
-                'name': filename
+        try:
+            self.shard(update).put_nowait(update)
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+                # Let Telegram's retry through once there is room
+                self.recent.pop(update_id, None)
+            return 'full'
+        return 'queued'
+    
+    def work(self, q):
+        while True:
+            update = q.get()
+            ok = True
+            try:
+                process_update(update)
+            except Exception as e:
+                ok = False
+                logger.error(f"Webhook error: {e}", exc_info=True)
+            finally:
+                with self.lock:
+                    self.processed += 1
+                    self.failed += 0 if ok else 1
+                q.task_done()
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'queue_depth': sum(q.qsize() for q in self.queues),
+                'received': self.received,
+                'duplicates': self.duplicates,
+                'rejected': self.rejected,
+                'processed': self.processed,
+                'failed': self.failed
             }
-            
-            # Add to messages
-            messages[sid].append({
-                'from': 'admin',
-                'message': message_text,
-                'type': 'file',
-                'file_id': fid,
-                'filename': filename,
-                'timestamp': datetime.now().isoformat()
-            })
-            
-            send_message(ADMIN_ID, f"✅ File sent to: <code>{sid}</code>")
-            logger.info(f"File sent to {sid}")
+
+def sessions_callback(view, offset, query=''):
+    """callback_data for a /sessions page button (Telegram allows 64 bytes)"""
+    return f'sessions:{view}:{offset}:{query}'.encode()[:64].decode('utf-8', 'ignore')
+
+def render_sessions_page(view, offset, query=''):
+    """Text and inline keyboard for one page of /sessions"""
+    rows, has_more = store.page_sessions(view, offset, SESSIONS_PAGE_SIZE, query)
+    if view == 'unread':
+        title = f"📬 <b>Unread Sessions: {store.unread_count()}</b>"
+        empty = "📭 <b>No unread sessions</b>"
+    elif view == 'find':
+        title = f"🔎 <b>Sessions matching</b> <code>{html.escape(query)}</code>"
+        empty = f"🔎 No session matches <code>{html.escape(query)}</code>"
+    else:
+        title = f"📊 <b>Active Sessions: {store.session_count()}</b>"
+        empty = "📭 <b>No active sessions</b>"
+    if not rows and not offset:
+        return empty, None
+    
+    now = time.time()
+    msg_text = f"{title}\n\n"
+    for sid, data in rows:
+        # New-style IDs carry their creation time
+        started = sid_generator.timestamp(sid) or epoch_time(data['started'])
+        minutes = int(now - started) // 60
+        msg_text += (
+            f"🆔 <code>{sid}</code>\n"
+            f"👤 {data['name']}\n"
+            f"⏱️ {minutes // 60}h {minutes % 60}m\n"
+            f"💬 {store.message_count(sid)} messages\n"
+        )
+        if data.get('unread'):
+            msg_text += f"🔴 {data['unread']} unread\n"
+        msg_text += "\n"
+    msg_text += f"<i>Page {offset // SESSIONS_PAGE_SIZE + 1}</i>"
+    
+    buttons = []
+    if offset:
+        buttons.append({'text': '◀️ Prev', 'callback_data': sessions_callback(view, max(offset - SESSIONS_PAGE_SIZE, 0), query)})
+    if has_more:
+        buttons.append({'text': 'Next ▶️', 'callback_data': sessions_callback(view, offset + SESSIONS_PAGE_SIZE, query)})
+    return msg_text, {'inline_keyboard': [buttons]} if buttons else None
+
+def process_callback(callback):
+    """Inline keyboard press in the admin chat"""
+    message = callback.get('message') or {}
+    if str(message.get('chat', {}).get('id')) != ADMIN_ID:
+        logger.info(f"Ignoring callback from non-admin: {callback.get('from', {}).get('id')}")
+        return
+    
+    parts = callback.get('data', '').split(':', 3)
+    if parts[0] == 'sessions' and len(parts) == 4:
+        text, markup = render_sessions_page(parts[1], read_cursor(parts[2]), parts[3])
+        dispatcher.submit(edit_message, ADMIN_ID, message['message_id'], text, markup, priority=PRIORITY_HIGH)
+    dispatcher.submit(answer_callback, callback['id'], priority=PRIORITY_HIGH)
+
+def process_update(update):
+    """Apply one Telegram update (admin replies, files, commands and
+    inline keyboard presses)"""
+    if 'callback_query' in update:
+        process_callback(update['callback_query'])
+        return
+    
+    if 'message' not in update:
+        return
+    
+    msg = update['message']
+    chat_id = str(msg['chat']['id'])
+    
+    # Only process messages from admin
+    if chat_id != ADMIN_ID:
+        logger.info(f"Ignoring message from non-admin: {chat_id}")
+        return
+    
+    # Handle text messages (replies)
+    if 'text' in msg:
+        text = msg['text'].strip()
         
-        # Handle voice messages from admin
-        elif 'voice' in msg:
-            caption = msg.get('caption', '').strip()
-            
-            if 'SES_' not in caption:
-                send_message(ADMIN_ID, "⚠️ Caption এ session ID দিন\nExample: <code>SES_xxxxx</code>")
-                return jsonify({'ok': True})
-            
-            sid = caption.split(':')[0].strip() if ':' in caption else caption.split()[0].strip()
-            message_text = caption.split(':', 1)[1].strip() if ':' in caption else ''
-            
-            if sid not in sessions:
-                send_message(ADMIN_ID, f"❌ Session not found: <code>{sid}</code>")
-                return jsonify({'ok': True})
+        # /start command
+        if text == '/start':
+            welcome = (
+                "✅ <b>Live Chat Bot Active!</b>\n\n"
+                "🔹 Visitor থেকে message আসলে notification পাবেন\n"
+                "🔹 Text reply: <code>SES_xxxxx: Your message</code>\n"
+                "🔹 Photo/File reply: Photo/file পাঠান + caption এ <code>SES_xxxxx</code> লিখুন\n"
+                "🔹 Voice reply: Voice message পাঠান + caption এ <code>SES_xxxxx</code>\n\n"
+                "<b>Commands:</b>\n"
+                "/sessions - Active sessions দেখুন\n"
+                "/sessions unread - Unread sessions দেখুন\n"
+                "/sessions find নাম - Name/email দিয়ে খুঁজুন\n"
+                "/close SES_xxxxx - Session বন্ধ করুন\n"
+                "/broadcast message - সবাইকে message পাঠান"
+            )
+            notify_admin(welcome)
+            return
+        
+        # /sessions [unread | find <text>] command
+        if text == '/sessions' or text.startswith('/sessions '):
+            arg = text[len('/sessions'):].strip()
+            if arg == 'unread':
+                view, query = 'unread', ''
+            elif arg.startswith('find '):
+                view, query = 'find', arg[len('find '):].strip()
+            else:
+                view, query = 'recent', ''
             
-            # Download voice
-            voice = msg['voice']
-            file_id = voice['file_id']
-            voice_data = download_telegram_file(file_id)
+            msg_text, markup = render_sessions_page(view, 0, query)
+            notify_admin(msg_text, reply_markup=markup)
+            return
+        
+        # /close command
+        if text.startswith('/close '):
+            sid = text.replace('/close ', '').strip()
             
-            if not voice_data:
-                send_message(ADMIN_ID, "❌ Failed to download voice")
-                return jsonify({'ok': True})
+            session_data = store.get_session(sid)
+            if not session_data:
+                notify_admin(f"❌ Session not found: <code>{sid}</code>")
+            else:
+                user_name = session_data['name']
+                
+                append_message(sid, {
+                    'from': 'admin',
+                    'message': '⚠️ এই চ্যাট সেশন বন্ধ করা হয়েছে। নতুন চ্যাট শুরু করতে পেজ রিফ্রেশ করুন।',
+                    'type': 'text',
+                    'timestamp': time.time()
+                })
+                
+                store.delete_session(sid)
+                expiry.closed(sid)
+                notify_session(sid)
+                bus.publish('closed', sid=sid)
+                notify_admin(f"✅ Session closed: <code>{sid}</code>\n👤 User: {user_name}", PRIORITY_LOW)
+            return
+        
+        # /broadcast command
+        if text.startswith('/broadcast '):
+            broadcast_msg = text.replace('/broadcast ', '').strip()
             
-            # Store file
-            fid = str(uuid.uuid4())
-            filename = f'voice_{fid}.ogg'
+            if not broadcast_msg:
+                notify_admin("⚠️ Usage: <code>/broadcast Your message</code>")
+                return
             
-            files[fid] = {
-                'data': base64.b64encode(voice_data).decode(),
-                'mime': 'audio/ogg',
-                'name': filename
-            }
+            session_count = store.session_count()
+            if not session_count:
+                notify_admin("📭 No active sessions")
+                return
             
-            # Add to messages
-            messages[sid].append({
+            # Written once; each session copies it into its log on its next read or append
+            store.append_broadcast({
                 'from': 'admin',
-                'message': message_text if message_text else '🎤 Voice message',
-                'type': 'voice',
-                'file_id': fid,
-                'filename': filename,
-                'timestamp': datetime.now().isoformat()
+                'message': f"📢 <b>Announcement:</b> {broadcast_msg}",
+                'type': 'text',
+                'timestamp': time.time(),
+                'broadcast': True
             })
+            notify_all_sessions()
+            bus.publish('broadcast')
             
-            send_message(ADMIN_ID, f"✅ Voice sent to: <code>{sid}</code>")
-            logger.info(f"Voice sent to {sid}")
+            notify_admin(f"📢 Broadcast sent to {session_count} session(s)", PRIORITY_LOW)
+            return
         
-        # Handle audio messages from admin
-        elif 'audio' in msg:
-            caption = msg.get('caption', '').strip()
-            
-            if 'SES_' not in caption:
-                send_message(ADMIN_ID, "⚠️ Caption এ session ID দিন")
-                return jsonify({'ok': True})
-            
-            sid = caption.split(':')[0].strip() if ':' in caption else caption.split()[0].strip()
-            message_text = caption.split(':', 1)[1].strip() if ':' in caption else ''
-            
-            if sid not in sessions:
-                send_message(ADMIN_ID, f"❌ Session not found: <code>{sid}</code>")
-                return jsonify({'ok': True})
-            
-            # Download audio
-            audio = msg['audio']
-            file_id = audio['file_id']
-            audio_data = download_telegram_file(file_id)
-            
-            if not audio_data:
-                send_message(ADMIN_ID, "❌ Failed to download audio")
-                return jsonify({'ok': True})
-            
-            # Store file
-            fid = str(uuid.uuid4())
-            filename = audio.get('file_name', f'audio_{fid}.mp3')
-            mime_type = audio.get('mime_type', 'audio/mpeg')
-            
-            files[fid] = {
-                'data': base64.b64encode(audio_data).decode(),
-                'mime': mime_type,
-                'name': filename
-            }
-            
-            # Add to messages
-            messages[sid].append({
-                'from': 'admin',
-                'message': message_text if message_text else '🎵 Audio message',
-                'type': 'voice',
-                'file_id': fid,
-                'filename': filename,
-                'timestamp': datetime.now().isoformat()
-            })
+        # Reply to visitor
+        if ':' in text and 'SES_' in text:
+            parts = text.split(':', 1)
+            sid = parts[0].strip()
+            reply = parts[1].strip() if len(parts) > 1 else ''
             
-            send_message(ADMIN_ID, f"✅ Audio sent to: <code>{sid}</code>")
-            logger.info(f"Audio sent to {sid}")
+            if store.has_session(sid):
+                append_message(sid, {
+                    'from': 'admin',
+                    'message': reply,
+                    'type': 'text',
+                    'timestamp': time.time()
+                })
+                notify_admin(f"✅ Reply sent to: <code>{sid}</code>", PRIORITY_LOW)
+                logger.info(f"Reply added to {sid}")
+            else:
+                notify_admin(f"❌ Session not found: <code>{sid}</code>")
+    
+    # Handle photo messages from admin
+    elif 'photo' in msg:
+        caption = msg.get('caption', '').strip()
         
+        if 'SES_' not in caption:
+            notify_admin("⚠️ Caption এ session ID দিন\nExample: <code>SES_xxxxx</code>")
+            return
+        
+        # Extract session ID
+        sid = caption.split(':')[0].strip() if ':' in caption else caption.split()[0].strip()
+        message_text = caption.split(':', 1)[1].strip() if ':' in caption else ''
+        
+        if not store.has_session(sid):
+            notify_admin(f"❌ Session not found: <code>{sid}</code>")
+            return
+        
+        # Download photo
+        photo = msg['photo'][-1]  # Highest resolution
+        stored = telegram_files.fetch(photo, 'photo')
+        
+        if not stored:
+            notify_admin("❌ Failed to download photo")
+            return
+        
+        # Store file
+        fid = str(uuid.uuid4())
+        register_file(fid, *stored, 'image/jpeg', f'photo_{fid}.jpg', sid)
+        
+        # Add to messages
+        append_message(sid, {
+            'from': 'admin',
+            'message': message_text,
+            'type': 'image',
+            'file_id': fid,
+            'filename': f'photo_{fid}.jpg',
+            'timestamp': time.time()
+        })
+        
+        notify_admin(f"✅ Photo sent to: <code>{sid}</code>", PRIORITY_LOW)
+        logger.info(f"Photo sent to {sid}")
+    
+    # Handle document/file messages from admin
+    elif 'document' in msg:
+        caption = msg.get('caption', '').strip()
+        
+        if 'SES_' not in caption:
+            notify_admin("⚠️ Caption এ session ID দিন\nExample: <code>SES_xxxxx</code>")
+            return
+        
+        sid = caption.split(':')[0].strip() if ':' in caption else caption.split()[0].strip()
+        message_text = caption.split(':', 1)[1].strip() if ':' in caption else ''
+        
+        if not store.has_session(sid):
+            notify_admin(f"❌ Session not found: <code>{sid}</code>")
+            return
+        
+        # Download document
+        document = msg['document']
+        stored = telegram_files.fetch(document, 'document')
+        
+        if not stored:
+            notify_admin("❌ Failed to download file")
+            return
+        
+        # Store file
+        fid = str(uuid.uuid4())
+        filename = document.get('file_name', f'file_{fid}')
+        mime_type = document.get('mime_type', 'application/octet-stream')
+        
+        register_file(fid, *stored, mime_type, filename, sid)
+        
+        # Add to messages
+        append_message(sid, {
+            'from': 'admin',
+            'message': message_text,
+            'type': 'file',
+            'file_id': fid,
+            'filename': filename,
+            'timestamp': time.time()
+        })
+        
+        notify_admin(f"✅ File sent to: <code>{sid}</code>", PRIORITY_LOW)
+        logger.info(f"File sent to {sid}")
+    
+    # Handle voice messages from admin
+    elif 'voice' in msg:
+        caption = msg.get('caption', '').strip()
+        
+        if 'SES_' not in caption:
+            notify_admin("⚠️ Caption এ session ID দিন\nExample: <code>SES_xxxxx</code>")
+            return
+        
+        sid = caption.split(':')[0].strip() if ':' in caption else caption.split()[0].strip()
+        message_text = caption.split(':', 1)[1].strip() if ':' in caption else ''
+        
+        if not store.has_session(sid):
+            notify_admin(f"❌ Session not found: <code>{sid}</code>")
+            return
+        
+        # Download voice
+        voice = msg['voice']
+        stored = telegram_files.fetch(voice, 'voice')
+        
+        if not stored:
+            notify_admin("❌ Failed to download voice")
+            return
+        
+        # Store file
+        fid = str(uuid.uuid4())
+        filename = f'voice_{fid}.ogg'
+        
+        register_file(fid, *stored, 'audio/ogg', filename, sid)
+        
+        # Add to messages
+        append_message(sid, {
+            'from': 'admin',
+            'message': message_text if message_text else '🎤 Voice message',
+            'type': 'voice',
+            'file_id': fid,
+            'filename': filename,
+            'timestamp': time.time()
+        })
+        
+        notify_admin(f"✅ Voice sent to: <code>{sid}</code>", PRIORITY_LOW)
+        logger.info(f"Voice sent to {sid}")
+    
+    # Handle audio messages from admin
+    elif 'audio' in msg:
+        caption = msg.get('caption', '').strip()
+        
+        if 'SES_' not in caption:
+            notify_admin("⚠️ Caption এ session ID দিন")
+            return
+        
+        sid = caption.split(':')[0].strip() if ':' in caption else caption.split()[0].strip()
+        message_text = caption.split(':', 1)[1].strip() if ':' in caption else ''
+        
+        if not store.has_session(sid):
+            notify_admin(f"❌ Session not found: <code>{sid}</code>")
+            return
+        
+        # Download audio
+        audio = msg['audio']
+        stored = telegram_files.fetch(audio, 'audio')
+        
+        if not stored:
+            notify_admin("❌ Failed to download audio")
+            return
+        
+        # Store file
+        fid = str(uuid.uuid4())
+        filename = audio.get('file_name', f'audio_{fid}.mp3')
+        mime_type = audio.get('mime_type', 'audio/mpeg')
+        
+        register_file(fid, *stored, mime_type, filename, sid)
+        
+        # Add to messages
+        append_message(sid, {
+            'from': 'admin',
+            'message': message_text if message_text else '🎵 Audio message',
+            'type': 'voice',
+            'file_id': fid,
+            'filename': filename,
+            'timestamp': time.time()
+        })
+        
+        notify_admin(f"✅ Audio sent to: <code>{sid}</code>", PRIORITY_LOW)
+        logger.info(f"Audio sent to {sid}")
+
+updates = UpdateQueue(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, WEBHOOK_DEDUP_WINDOW)
+
+@app.route('/api/chat/webhook', methods=['POST'])
+def webhook():
+    if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        logger.warning("Webhook with missing or wrong secret token")
+        return jsonify({'ok': False, 'error': 'Forbidden'}), 403
+    
+    update = request.get_json(silent=True)
+    if not isinstance(update, dict):
+        # Nothing Telegram could fix by retrying
         return jsonify({'ok': True})
-    except Exception as e:
-        logger.error(f"Webhook error: {e}", exc_info=True)
-        return jsonify({'ok': True})
+    logger.info(f"Webhook received: {json.dumps(update)[:200]}")
+    
+    if updates.submit(update) == 'full':
+        # Non-2xx makes Telegram redeliver later
+        return jsonify({'ok': False, 'error': 'Busy'}), 503
+    return jsonify({'ok': True})
 
 @app.route('/health', methods=['GET'])
 def health():
+    session_count = store.session_count()
     return jsonify({
         'status': 'healthy',
-        'active_sessions': len(sessions),
-        'total_messages': sum(len(m) for m in messages.values()),
-        'session_ids': list(sessions.keys()) if len(sessions) < 10 else f"{len(sessions)} active"
+        'active_sessions': session_count,
+        'total_messages': store.total_messages(),
+        'session_ids': store.session_ids() if session_count < 10 else f"{session_count} active",
+        'telegram': dispatcher.stats(),
+        'telegram_limits': rate_limiter.stats(),
+        'expiry': expiry.stats(),
+        'webhook': updates.stats(),
+        'images': images.stats(),
+        'telegram_files': telegram_files.stats(),
+        'journal': dict(store.journal.stats(), recovery_ms=store.recovery_ms)
+                   if isinstance(store, JournaledStore) else None,
+        'bus': bus.stats()
     })
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus scrape target: request/Bot API histograms plus the same
+    O(1) counters /health reports, flattened into gauges"""
+    gauges = [
+        ('livechat_sessions', 'Active sessions', store.session_count()),
+        ('livechat_sessions_unread', 'Sessions with unread visitor messages', store.unread_count()),
+        ('livechat_messages', 'Stored messages across all sessions', store.total_messages()),
+        ('livechat_files', 'Stored file records', store.file_count()),
+    ]
+    components = (
+        ('telegram_dispatch', dispatcher.stats()),
+        ('telegram_limits', rate_limiter.stats()),
+        ('telegram_files', telegram_files.stats()),
+        ('webhook', updates.stats()),
+        ('images', images.stats()),
+        ('expiry', expiry.stats()),
+        ('bus', bus.stats()),
+    )
+    for component, stats in components:
+        for key, value in stats.items():
+            # bools (images.enabled) export as 0/1; lists and names are skipped
+            if isinstance(value, (int, float)):
+                gauges.append((f'livechat_{component}_{key}', f'{component} {key} (see /health)', int(value)
+                               if isinstance(value, bool) else value))
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
 @app.route('/test-bot', methods=['GET'])
 def test_bot():
     try:
@@ -721,7 +4191,10 @@ def setup_webhook():
         telegram_request('deleteWebhook')
         
         # Set new webhook
-        result = telegram_request('setWebhook', {'url': webhook_url})
+        params = {'url': webhook_url}
+        if WEBHOOK_SECRET:
+            params['secret_token'] = WEBHOOK_SECRET
+        result = telegram_request('setWebhook', params)
         
         return jsonify({
             'success': result.get('ok', False) if result else False,
@@ -742,13 +4215,14 @@ def webhook_info():
 
 @app.route('/debug/session/<sid>', methods=['GET'])
 def debug_session(sid):
-    return jsonify({
-        'session_exists': sid in sessions,
-        'session_data': sessions.get(sid, {}),
-        'message_count': len(messages.get(sid, [])),
-        'messages': messages.get(sid, [])[-5:],  # Last 5 messages
-        'all_sessions': list(sessions.keys())
-    })
+    store.deliver_broadcasts(sid)
+    message_count = store.message_count(sid)
+    return messages_response({
+        'session_exists': store.has_session(sid),
+        'session_data': store.get_session(sid) or {},
+        'message_count': message_count,
+        'all_sessions': store.session_ids()
+    }, store.get_fragments(sid, max(message_count - 5, 0)))  # Last 5 messages
 
 @app.route('/')
 def index():
@@ -771,6 +4245,9 @@ def index():
         ]
     })
 
+expiry.start()
+bus.start()
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     logger.info(f"Starting on port {port}")
@@ -0,0 +1,340 @@
+"""Load test: N simulated widget visitors against a real app process and a
+local stand-in for api.telegram.org.
+
+Each visitor runs the widget's flow (init, then poll on every tick with a
+send and the occasional upload in between) while a scripted admin replies
+through /api/chat/webhook, now and then with a document. The fake Bot API
+can add latency, answer 429 or hang past TELEGRAM_TIMEOUT. The report has
+per-endpoint throughput and p50/p99 latency, plus the app's peak thread
+count and RSS (read from /proc, so Linux only).
+
+    python benchmarks/load_test.py --visitors 50 --duration 30
+    python benchmarks/load_test.py --latency 200 --rate-429 0.05 --timeouts 0.01
+    STORAGE_BACKEND=sqlite python benchmarks/load_test.py
+
+Any other app setting (TELEGRAM_WORKERS, COALESCE_WINDOW, ...) is passed
+through from the environment.
+"""
+import argparse
+import collections
+import http.client
+import http.server
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app.py')
+BOT_TOKEN = 'bench'
+ADMIN_ID = 1
+
+
+class FakeTelegramServer(http.server.ThreadingHTTPServer):
+    """Bot API stand-in that counts calls and misbehaves on request"""
+
+    daemon_threads = True
+
+    def __init__(self, latency, rate_429, timeouts, hang):
+        super().__init__(('127.0.0.1', 0), FakeTelegramHandler)
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.timeouts = timeouts
+        self.hang = hang
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.message_ids = iter(range(1, 1 << 62))
+
+    def count(self, key):
+        with self.lock:
+            self.calls[key] += 1
+
+
+class FakeTelegramHandler(http.server.BaseHTTPRequestHandler):
+    # Keep-alive, like the real API, so the app's connection pool is exercised
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.startswith(f'/file/bot{BOT_TOKEN}/'):
+            self.server.count('download')
+            if not self.misbehave():
+                self.reply(200, b'%PDF-1.4 price list ' + b'x' * 20000, 'application/pdf')
+        else:
+            self.do_POST()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        method = self.path.rsplit('/', 1)[-1]
+        self.server.count(method)
+        if not self.misbehave():
+            self.reply(200, json.dumps({'ok': True, 'result': self.result(method)}).encode())
+
+    def misbehave(self):
+        """Sleep for the configured latency, then maybe hang or answer 429"""
+        server = self.server
+        if server.latency:
+            time.sleep(random.expovariate(1000 / server.latency))
+        roll = random.random()
+        if roll < server.timeouts:
+            server.count('injected_timeout')
+            time.sleep(server.hang)
+            self.close_connection = True
+            return True
+        if roll < server.timeouts + server.rate_429:
+            server.count('injected_429')
+            self.reply(429, json.dumps({
+                'ok': False,
+                'error_code': 429,
+                'description': 'Too Many Requests: retry after 1',
+                'parameters': {'retry_after': 1}
+            }).encode())
+            return True
+        return False
+
+    def result(self, method):
+        message = {'message_id': next(self.server.message_ids), 'chat': {'id': ADMIN_ID}}
+        tag = uuid.uuid4().hex[:12]
+        if method == 'getFile':
+            return {'file_id': tag, 'file_path': f'documents/{tag}.pdf'}
+        if method == 'sendPhoto':
+            message['photo'] = [{'file_id': f'photo-{tag}', 'file_unique_id': tag}]
+        elif method == 'sendDocument':
+            message['document'] = {'file_id': f'document-{tag}', 'file_unique_id': tag}
+        elif method == 'sendVoice':
+            message['voice'] = {'file_id': f'voice-{tag}', 'file_unique_id': tag}
+        return message
+
+    def reply(self, status, body, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Recorder:
+    """Latency samples and error counts per endpoint label"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = collections.defaultdict(list)
+        self.errors = collections.Counter()
+
+    def add(self, label, seconds, ok):
+        with self.lock:
+            self.samples[label].append(seconds)
+            if not ok:
+                self.errors[label] += 1
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))]
+
+
+def call(port, recorder, label, method, path, body=None, headers=None):
+    """One request on a fresh connection, returning (status, body) or (None, b'')"""
+    started = time.perf_counter()
+    status, payload = None, b''
+    try:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        status, payload = response.status, response.read()
+        conn.close()
+    except Exception:
+        pass
+    recorder.add(label, time.perf_counter() - started, status is not None and status < 400)
+    return status, payload
+
+
+def post_json(port, recorder, label, path, data):
+    return call(port, recorder, label, 'POST', path, json.dumps(data).encode(), {'Content-Type': 'application/json'})
+
+
+def multipart(fields, filename, content, mime_type):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    parts.append(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f'Content-Type: {mime_type}\r\n\r\n'.encode() + content + b'\r\n'
+    )
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+
+
+def visitor(index, args, port, recorder, sessions, stop):
+    status, body = post_json(port, recorder, 'init', '/api/chat/init', {
+        'name': f'Visitor {index}', 'email': f'visitor{index}@example.com'
+    })
+    if status != 200:
+        return
+    sid = json.loads(body)['session_id']
+    sessions.append(sid)
+    page = {'page_url': f'https://example.com/products/{index % 20}', 'page_title': f'Product {index % 20}'}
+
+    seq = 0
+    tick = 0
+    while not stop.is_set():
+        tick += 1
+        if tick % args.send_every == 0:
+            post_json(port, recorder, 'send', '/api/chat/send', dict(page, session_id=sid, message=f'Question {tick}?'))
+        if args.upload_every and tick % args.upload_every == 0:
+            body, headers = multipart(dict(page, session_id=sid, message='Screenshot'),
+                                      'screenshot.bin', os.urandom(args.upload_kb * 1024), 'application/octet-stream')
+            call(port, recorder, 'upload', 'POST', '/api/chat/upload', body, headers)
+        status, body = call(port, recorder, 'poll', 'GET', f'/api/chat/poll/{sid}?after={seq}')
+        if status == 200:
+            seq = json.loads(body).get('last_seq', seq)
+        stop.wait(args.think * random.uniform(0.5, 1.5))
+
+
+def admin(args, port, recorder, sessions, stop):
+    update_id = 0
+    while not stop.wait(1 / args.admin_rate):
+        if not sessions:
+            continue
+        update_id += 1
+        sid = random.choice(sessions)
+        message = {'message_id': update_id, 'chat': {'id': ADMIN_ID}, 'from': {'id': ADMIN_ID}}
+        if update_id % 10 == 0:
+            # The same price list every time: one download, then file cache hits
+            message.update(caption=f'{sid}: Price list', document={
+                'file_id': f'price-list-{update_id}', 'file_unique_id': 'price-list',
+                'file_name': 'price-list.pdf', 'mime_type': 'application/pdf'
+            })
+        else:
+            message['text'] = f'{sid}: Reply {update_id}'
+        post_json(port, recorder, 'webhook', '/api/chat/webhook', {'update_id': update_id, 'message': message})
+
+
+def process_status(pid):
+    """(threads, RSS in MB) of a process, from /proc"""
+    threads = rss = 0
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('Threads:'):
+                    threads = int(line.split()[1])
+                elif line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return threads, rss
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_app(args, telegram_port, workdir):
+    port = free_port()
+    env = dict(
+        os.environ,
+        PORT=str(port),
+        TELEGRAM_API_BASE=f'http://127.0.0.1:{telegram_port}',
+        TELEGRAM_BOT_TOKEN=BOT_TOKEN,
+        ADMIN_CHAT_ID=str(ADMIN_ID),
+        TELEGRAM_TIMEOUT=str(args.telegram_timeout),
+        WEBHOOK_SECRET='',
+    )
+    env.setdefault('BLOB_DIR', os.path.join(workdir, 'blobs'))
+    env.setdefault('SQLITE_PATH', os.path.join(workdir, 'chat.db'))
+    log = open(os.path.join(workdir, 'app.log'), 'wb')
+    proc = subprocess.Popen([sys.executable, APP], env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/health')
+            if conn.getresponse().status == 200:
+                return proc, port
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    sys.exit(f"App did not come up, see {log.name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--visitors', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load after ramp-up')
+    parser.add_argument('--think', type=float, default=1.0, help='mean seconds between a visitor\'s polls')
+    parser.add_argument('--send-every', type=int, default=3, help='send a message every N polls')
+    parser.add_argument('--upload-every', type=int, default=20, help='upload a file every N polls (0 = never)')
+    parser.add_argument('--upload-kb', type=int, default=200)
+    parser.add_argument('--admin-rate', type=float, default=2, help='admin replies per second')
+    parser.add_argument('--latency', type=float, default=50, help='mean fake Bot API latency, ms')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='fraction of Bot API calls answered 429')
+    parser.add_argument('--timeouts', type=float, default=0.0, help='fraction of Bot API calls that hang')
+    parser.add_argument('--telegram-timeout', type=float, default=2, help='TELEGRAM_TIMEOUT for the app, seconds')
+    args = parser.parse_args()
+
+    telegram = FakeTelegramServer(args.latency, args.rate_429, args.timeouts, args.telegram_timeout + 1)
+    threading.Thread(target=telegram.serve_forever, daemon=True).start()
+    workdir = tempfile.mkdtemp(prefix='lvchat-load-')
+    proc, port = start_app(args, telegram.server_address[1], workdir)
+    _, rss_start = process_status(proc.pid)
+
+    recorder = Recorder()
+    sessions = []
+    stop = threading.Event()
+    threads = [threading.Thread(target=admin, args=(args, port, recorder, sessions, stop), daemon=True)]
+    for i in range(args.visitors):
+        threads.append(threading.Thread(target=visitor, args=(i, args, port, recorder, sessions, stop), daemon=True))
+
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+        # Spread the visitors' first requests over one think time
+        time.sleep(args.think / max(args.visitors, 1))
+    peak_threads = peak_rss = 0
+    while time.monotonic() - started < args.duration:
+        count, rss = process_status(proc.pid)
+        peak_threads, peak_rss = max(peak_threads, count), max(peak_rss, rss)
+        time.sleep(0.5)
+    stop.set()
+    for thread in threads:
+        thread.join(timeout=10)
+    elapsed = time.monotonic() - started
+
+    status, body = call(port, Recorder(), 'health', 'GET', '/health')
+    health = json.loads(body) if status == 200 else {}
+    proc.terminate()
+    proc.wait(timeout=10)
+
+    print(f"visitors: {args.visitors}  duration: {elapsed:.1f}s  storage: {os.environ.get('STORAGE_BACKEND', 'memory')}")
+    print(f"fake Bot API: {args.latency:g} ms mean latency, {args.rate_429:.1%} 429s, {args.timeouts:.1%} timeouts")
+    print(f"{'endpoint':<10}{'requests':>10}{'req/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'errors':>8}")
+    total = 0
+    for label in ('init', 'send', 'upload', 'poll', 'webhook'):
+        samples = sorted(recorder.samples.get(label, []))
+        total += len(samples)
+        print(f"{label:<10}{len(samples):>10}{len(samples) / elapsed:>9.1f}"
+              f"{percentile(samples, 50) * 1000:>9.1f}{percentile(samples, 99) * 1000:>9.1f}{recorder.errors[label]:>8}")
+    print(f"{'total':<10}{total:>10}{total / elapsed:>9.1f}")
+    print(f"app: peak {peak_threads} threads, peak RSS {peak_rss:.1f} MB (started at {rss_start:.1f} MB)")
+    print(f"Bot API calls: {dict(sorted(telegram.calls.items()))}")
+    dispatch = health.get('telegram', {})
+    print(f"app telegram queue: {dispatch.get('completed', '?')} sent, {dispatch.get('failed', '?')} failed, "
+          f"{dispatch.get('dropped', '?')} dropped, {dispatch.get('queue_depth', '?')} still queued")
+    print(f"app webhook: {health.get('webhook', {})}")
+    print(f"app file cache: {health.get('telegram_files', {})}")
+    print(f"app log: {os.path.join(workdir, 'app.log')}")
+
+
+if __name__ == '__main__':
+    main()
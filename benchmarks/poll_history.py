@@ -0,0 +1,71 @@
+"""Full-history poll throughput: re-encoding message dicts vs. splicing the
+cached JSON fragments.
+
+"dicts" is what poll() used to do (get_messages() + jsonify); "fragments"
+is the current poll() body (get_fragments() + messages_response()).
+
+    python benchmarks/poll_history.py [messages ...]
+    STORAGE_BACKEND=sqlite SQLITE_PATH=/tmp/bench.db python benchmarks/poll_history.py
+"""
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('BLOB_DIR', tempfile.mkdtemp(prefix='lvchat-bench-'))
+os.environ['MESSAGE_HOT_MAX'] = '0'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app  # noqa: E402
+
+
+def fill(count):
+    sid = app.sid_generator.next()
+    app.store.create_session(sid, {'name': 'Bench', 'email': '', 'started': time.time(), 'last_active': time.time()})
+    for i in range(count):
+        if i % 2:
+            app.store.append_message(sid, {'from': 'admin', 'message': f'Reply number {i}', 'type': 'text',
+                                           'timestamp': time.time()})
+        else:
+            app.store.append_message(sid, {'from': 'visitor', 'message': f'Visitor question number {i}?',
+                                           'type': 'text', 'timestamp': time.time(),
+                                           'page_url': 'https://example.com/pricing',
+                                           'page_title': 'Pricing - Example'})
+    return sid
+
+
+def dicts(sid):
+    msgs = app.store.get_messages(sid, 0)
+    return app.jsonify({'success': True, 'messages': msgs, 'last_seq': len(msgs), 'total_count': len(msgs)}).get_data()
+
+
+def fragments(sid):
+    msgs = app.store.get_fragments(sid, 0)
+    return app.messages_response({'success': True, 'last_seq': len(msgs), 'total_count': len(msgs)}, msgs).get_data()
+
+
+def rate(fn, sid, seconds=1.0):
+    calls = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        fn(sid)
+        calls += 1
+    return calls / (time.perf_counter() - started)
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 5000]
+    print(f"storage: {app.STORAGE_BACKEND}")
+    print(f"{'messages':>9}{'dicts/s':>12}{'fragments/s':>14}{'speedup':>9}")
+    with app.app.test_request_context():
+        for size in sizes:
+            sid = fill(size)
+            assert len(dicts(sid)) > 0 and len(fragments(sid)) > 0
+            before = rate(dicts, sid)
+            after = rate(fragments, sid)
+            print(f"{size:>9}{before:>12.1f}{after:>14.1f}{after / before:>8.1f}x")
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
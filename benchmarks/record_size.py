@@ -0,0 +1,105 @@
+"""Memory per message and per session: plain dicts vs. the compact records.
+
+Builds the same chat traffic twice, once the way the store used to hold
+it (a dict per message and session, ISO timestamp strings, page URL/title
+repeated on every visitor message) and once through MemoryStore, and
+reports the traced allocation per message and per session.
+
+    python benchmarks/record_size.py [sessions] [messages_per_session]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+# Keep the app's side effects (blob/history dirs, no trimming) out of the way
+os.environ.setdefault('BLOB_DIR', tempfile.mkdtemp(prefix='lvchat-bench-'))
+os.environ['MESSAGE_HOT_MAX'] = '0'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app  # noqa: E402
+
+PAGES = [
+    ('https://example.com/pricing', 'Pricing - Example'),
+    ('https://example.com/docs/getting-started', 'Getting started - Example Docs'),
+    ('https://example.com/checkout?plan=pro', 'Checkout - Example'),
+]
+
+
+def visitor_body(i):
+    """A request body as the app sees it: fresh strings on every request"""
+    url, title = PAGES[i % len(PAGES)]
+    return json.loads(json.dumps({'message': f'Hello, question number {i}?', 'page_url': url, 'page_title': title}))
+
+
+def build_legacy(sessions, per_session):
+    store = {'sessions': {}, 'messages': {}}
+    for s in range(sessions):
+        sid = f'SES_{s:017d}'
+        store['sessions'][sid] = {
+            'name': f'Visitor {s}', 'email': f'visitor{s}@example.com',
+            'started': datetime.now().isoformat(), 'last_active': datetime.now().isoformat(),
+            'initial_page': PAGES[0][0], 'initial_page_title': PAGES[0][1]
+        }
+        log = store['messages'][sid] = []
+        for i in range(per_session):
+            body = visitor_body(i)
+            if i % 2:
+                log.append({'from': 'admin', 'message': f'Reply {i}', 'type': 'text',
+                            'timestamp': datetime.now().isoformat()})
+            else:
+                log.append({'from': 'visitor', 'message': body['message'], 'type': 'text',
+                            'timestamp': datetime.now().isoformat(),
+                            'page_url': body['page_url'], 'page_title': body['page_title']})
+    return store
+
+
+def build_compact(sessions, per_session):
+    store = app.MemoryStore()
+    for s in range(sessions):
+        sid = f'SES_{s:017d}'
+        store.create_session(sid, {
+            'name': f'Visitor {s}', 'email': f'visitor{s}@example.com',
+            'started': time.time(), 'last_active': time.time(),
+            'initial_page': PAGES[0][0], 'initial_page_title': PAGES[0][1]
+        })
+        for i in range(per_session):
+            body = visitor_body(i)
+            if i % 2:
+                store.append_message(sid, {'from': 'admin', 'message': f'Reply {i}', 'type': 'text',
+                                           'timestamp': time.time()})
+            else:
+                store.append_message(sid, {'from': 'visitor', 'message': body['message'], 'type': 'text',
+                                           'timestamp': time.time(),
+                                           'page_url': body['page_url'], 'page_title': body['page_title']})
+    return store
+
+
+def measure(build, sessions, per_session):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build(sessions, per_session)
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def main():
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    per_session = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    print(f'{sessions} sessions x {per_session} messages')
+    print(f"{'layout':<10}{'total KiB':>12}{'B/message':>12}{'B/session':>12}")
+    for name, build in (('dict', build_legacy), ('compact', build_compact)):
+        with_messages = measure(build, sessions, per_session)
+        sessions_only = measure(build, sessions, 0)
+        per_message = (with_messages - sessions_only) / (sessions * per_session)
+        print(f'{name:<10}{with_messages / 1024:>12.0f}{per_message:>12.0f}{sessions_only / sessions:>12.0f}')
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Warm-restart cost of the journaled memory store.
+
+Fills a JournaledStore with sessions x messages, then times a fresh
+store recovering it twice: once by replaying the whole journal, once from
+a compacted snapshot. Also reports append throughput per fsync policy.
+
+    python benchmarks/recovery.py [sessions] [messages_per_session]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('BLOB_DIR', tempfile.mkdtemp(prefix='lvchat-bench-'))
+os.environ['MESSAGE_HOT_MAX'] = '0'
+os.environ['JOURNAL_DIR'] = ''
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app  # noqa: E402
+
+
+def open_store(root, fsync='never'):
+    return app.JournaledStore(app.Journal(root, fsync), app.ColdLog(os.path.join(root, 'history')))
+
+
+def fill(store, sessions, per_session):
+    started = time.perf_counter()
+    for s in range(sessions):
+        sid = app.sid_generator.next()
+        store.create_session(sid, {'name': f'Visitor {s}', 'email': f'v{s}@example.com',
+                                   'started': time.time(), 'last_active': time.time()})
+        for i in range(per_session):
+            if i % 2:
+                store.append_message(sid, {'from': 'admin', 'message': f'Reply number {i}', 'type': 'text'})
+            else:
+                store.append_message(sid, {'from': 'visitor', 'message': f'Visitor question number {i}?',
+                                           'type': 'text', 'page_url': 'https://example.com/pricing',
+                                           'page_title': 'Pricing - Example'})
+                store.touch_session(sid)
+    return time.perf_counter() - started
+
+
+def recover(root):
+    store = open_store(root)
+    started = time.perf_counter()
+    store.recover()
+    return store, time.perf_counter() - started
+
+
+def main():
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    per_session = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    total = sessions * per_session
+    root = tempfile.mkdtemp(prefix='lvchat-journal-')
+    app.logger.setLevel('WARNING')
+
+    print(f"{sessions} sessions x {per_session} messages = {total} messages")
+    for fsync in ('never', 'interval', 'always'):
+        path = tempfile.mkdtemp(prefix=f'lvchat-journal-{fsync}-')
+        store = open_store(path, fsync)
+        store.recover()
+        count = min(total, 2000) if fsync == 'always' else total
+        elapsed = fill(store, 1, count)
+        print(f"append, fsync={fsync:<9}{count / elapsed:>10.0f} messages/s")
+        shutil.rmtree(path)
+
+    store = open_store(root)
+    store.recover()
+    fill(store, sessions, per_session)
+    journal_bytes = sum(os.path.getsize(store.journal.segment_path(s)) for s in store.journal.segments())
+
+    replayed, elapsed = recover(root)
+    assert replayed.total_messages() == total
+    print(f"replay journal   {elapsed * 1000:>8.0f} ms  ({journal_bytes / 1e6:.1f} MB)")
+
+    started = time.perf_counter()
+    replayed.snapshot()
+    print(f"write snapshot   {(time.perf_counter() - started) * 1000:>8.0f} ms  "
+          f"({os.path.getsize(os.path.join(root, 'snapshot.json')) / 1e6:.1f} MB)")
+
+    restored, elapsed = recover(root)
+    assert restored.total_messages() == total
+    print(f"load snapshot    {elapsed * 1000:>8.0f} ms")
+    shutil.rmtree(root)
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,11 @@
+"""Settings the app reads at import time, pointed away from the working tree."""
+import os
+import sys
+import tempfile
+
+os.environ.setdefault('BLOB_DIR', tempfile.mkdtemp(prefix='lvchat-test-'))
+os.environ.setdefault('JOURNAL_DIR', '')
+os.environ.setdefault('IMAGE_WORKERS', '0')
+os.environ.setdefault('IMAGE_QUEUE_SIZE', '1')
+os.environ.setdefault('TELEGRAM_PHOTO_LIMIT', '16')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -0,0 +1,71 @@
+"""A photo over TELEGRAM_PHOTO_LIMIT must reach the admin even when its
+render job is dropped or fails before anyone waits on it."""
+import time
+
+import pytest
+
+import app
+
+
+def put_image(data=b'not really a png, but the mime type says so'):
+    fid = f'file_{time.monotonic_ns()}'
+    digest, size = app.blobs.put(data), len(data)
+    app.store.put_file(fid, {'sid': None, 'blob': digest, 'size': size, 'mime': 'image/png',
+                             'name': 'big.png', 'created': '2026-01-01T00:00:00'})
+    return fid
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    def make(workers, maxsize):
+        images = app.ImagePipeline(workers, maxsize)
+        monkeypatch.setattr(app.ImagePipeline, 'accepts', lambda self, mime_type: True)
+        monkeypatch.setattr(app, 'images', images)
+        return images
+    return make
+
+
+@pytest.fixture
+def admin(monkeypatch):
+    sent = []
+    monkeypatch.setattr(app.dispatcher, 'submit', lambda fn, *args, **kwargs: sent.append(args))
+    return sent
+
+
+def test_dropped_job_still_answers_late_waiter(pipeline):
+    images = pipeline(0, 1)
+    assert images.submit(put_image(b'first'))
+    fid = put_image()
+    assert not images.submit(fid)
+    
+    answers = []
+    images.when_ready(fid, answers.append)
+    assert answers == [None]
+    assert fid not in images.waiters
+
+
+def test_failed_render_still_answers_late_waiter(pipeline):
+    images = pipeline(1, 10)
+    fid = put_image()
+    images.submit(fid)
+    images.queue.join()
+    assert images.stats()['failed'] == 1
+    
+    answers = []
+    images.when_ready(fid, answers.append)
+    assert answers == [None]
+    assert fid not in images.waiters
+
+
+def test_oversized_photo_is_reported_when_queue_is_full(pipeline, admin):
+    images = pipeline(0, 1)
+    images.submit(put_image(b'first'))
+    sid = app.sid_generator.next()
+    app.store.create_session(sid, {'name': 'Visitor', 'started': time.time(), 'last_active': time.time()})
+    fid = put_image()
+    images.submit(fid)
+    
+    app.record_visitor_file(sid, fid, 'big.png', 'image/png', '', 'https://example.com', 'Home')
+    assert len(admin) == 1
+    assert 'too large for Telegram' in admin[0][-1]
+    assert not images.waiters
@@ -0,0 +1,140 @@
+"""A JournaledStore restarted on the same directory comes back with the
+state it had: from the journal alone, from a snapshot plus the journal
+tail, and with a torn last line."""
+import json
+import os
+
+import app
+
+
+def open_store(root):
+    store = app.JournaledStore(app.Journal(str(root / 'journal')), app.ColdLog(str(root / 'history')), 0, 2)
+    store.recover()
+    return store
+
+
+def restart(store, root):
+    store.journal.file.close()
+    return open_store(root)
+
+
+def fill(store, prefix, now=1700000000.0):
+    """Sessions with visitor/admin traffic, a trimmed head, a broadcast,
+    a file and a closed session"""
+    sids = [f'SES_{prefix}{i}' for i in range(3)]
+    for i, sid in enumerate(sids):
+        store.create_session(sid, {'name': f'Visitor {i}', 'email': f'v{i}@example.com',
+                                   'started': now, 'last_active': now,
+                                   'initial_page': 'https://example.com/', 'initial_page_title': 'Home'})
+    for n in range(6):
+        for sid in sids:
+            store.append_message(sid, {'from': 'visitor', 'message': f'{sid} question {n}', 'type': 'text',
+                                       'timestamp': now + n, 'page_url': f'https://example.com/{n % 2}',
+                                       'page_title': 'Page'})
+        store.append_message(sids[0], {'from': 'admin', 'message': f'reply {n}', 'type': 'text', 'timestamp': now + n})
+    store.append_broadcast({'from': 'admin', 'message': 'announcement', 'type': 'text',
+                            'timestamp': now + 10, 'broadcast': True})
+    store.append_message(sids[1], {'from': 'visitor', 'message': 'after the broadcast', 'timestamp': now + 11})
+    store.update_session(sids[2], name='Renamed')
+    store.trim_messages(sids[0], 5)
+    store.trim_messages(sids[1], 3)
+    store.put_file(f'file_{prefix}', {'sid': sids[1], 'blob': 'ab' * 32, 'size': 3, 'mime': 'text/plain',
+                                      'name': 'a.txt', 'created': '2024-01-01T00:00:00'})
+    store.delete_session(sids[2])
+    store.delete_messages(sids[2])
+    return sids
+
+
+def state(store):
+    """Everything a restart must keep. last_active is journaled coarsely
+    (once per SWEEP_INTERVAL), so it is left out."""
+    sessions = {}
+    for sid in store.session_ids():
+        data = store.get_session(sid)
+        data.pop('last_active')
+        sessions[sid] = data
+    return {
+        'sessions': sessions,
+        'messages': {sid: store.get_messages(sid, 0) for sid in store.messages},
+        'counts': {sid: store.message_count(sid) for sid in store.messages},
+        'trimmed': dict(store.trimmed),
+        'cold': {sid: store.cold.read(sid, 0, None) for sid in store.trimmed},
+        'unread': store.unread_count(),
+        'unread_page': [sid for sid, _ in store.page_sessions('unread', 0, 10)[0]],
+        'found': [sid for sid, _ in store.page_sessions('find', 0, 10, 'visitor')[0]],
+        'files': dict(store.files),
+        'broadcasts': store.broadcast_count(),
+        'total': store.total_messages(),
+    }
+
+
+def test_restart_replays_the_journal(tmp_path):
+    store = open_store(tmp_path)
+    fill(store, 'A')
+    before = state(store)
+    assert before['trimmed'] and before['unread']
+    
+    store = restart(store, tmp_path)
+    assert state(store) == before
+    assert store.recovered_entries > 0
+
+
+def test_restart_from_snapshot_and_tail(tmp_path):
+    store = open_store(tmp_path)
+    fill(store, 'A')
+    store.snapshot()
+    fill(store, 'B')
+    before = state(store)
+    
+    store = restart(store, tmp_path)
+    assert state(store) == before
+    # Twice, so the segment opened by the first recovery is read back too
+    sid = store.session_ids()[0]
+    store.append_message(sid, {'from': 'visitor', 'message': 'after restart', 'timestamp': 1700000100.0})
+    before = state(store)
+    store = restart(store, tmp_path)
+    assert state(store) == before
+
+
+def test_seqs_continue_after_restart(tmp_path):
+    store = open_store(tmp_path)
+    sid = fill(store, 'A')[0]
+    count = store.message_count(sid)
+    
+    store = restart(store, tmp_path)
+    # The broadcast it has not read yet takes the seq before the new message
+    assert store.append_message(sid, {'from': 'visitor', 'message': 'next', 'timestamp': 1700000100.0}) == count + 2
+    messages = store.get_messages(sid, 0)
+    assert [msg['seq'] for msg in messages] == list(range(1, count + 3))
+    assert [msg['message'] for msg in messages[-2:]] == ['announcement', 'next']
+
+
+def test_torn_last_line_is_ignored(tmp_path):
+    store = open_store(tmp_path)
+    sid = fill(store, 'A')[0]
+    before = state(store)
+    store.journal.file.write('["append_message",["' + sid + '",{"from":"vis')
+    store.journal.file.flush()
+    
+    store = restart(store, tmp_path)
+    assert state(store) == before
+    # Recovery continues in a fresh segment, never after the torn line
+    store.append_message(sid, {'from': 'admin', 'message': 'after the tear', 'timestamp': 1700000100.0})
+    before = state(store)
+    store = restart(store, tmp_path)
+    assert state(store) == before
+
+
+def test_unjournaled_history_lines_are_dropped(tmp_path):
+    store = open_store(tmp_path)
+    sid = fill(store, 'A')[0]
+    before = state(store)
+    # A ColdLog append whose 'trimmed' entry never reached the journal
+    hot = store.get_fragments(sid, store.trimmed[sid], store.trimmed[sid] + 1)
+    store.cold.append(sid, [fragment for _, fragment in hot])
+    
+    store = restart(store, tmp_path)
+    assert state(store) == before
+    with open(store.cold.path(sid), encoding='utf-8') as f:
+        assert [json.loads(line)['seq'] for line in f] == list(range(1, store.trimmed[sid] + 1))
+    assert os.path.exists(store.cold.path(sid))